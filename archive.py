@@ -0,0 +1,84 @@
+# archive.py
+#
+# Archival of retired TrackedAssignment documents. Documents retired
+# (iscurrent=False) for longer than a given age are moved in batches from
+# their collection to a history collection named <collection>_history,
+# with the same document layout, so the live collections only hold
+# current data and the rows retired recently. References to archived
+# documents are resolved from the history collection.
+#
+import time
+from pymongo import ReplaceOne
+from mongoengine.queryset import QuerySet
+
+HISTORY_SUFFIX = '_history'
+
+def history_name(classObj):
+    return classObj._get_collection_name() + HISTORY_SUFFIX
+
+def history_collection(classObj):
+    collection = classObj._get_collection()
+    return collection.database[history_name(classObj)]
+
+# A QuerySet over a class's history collection. Unlike switch_collection
+# this doesn't touch the class, so it is safe in a threaded server.
+def history_objects(classObj):
+    queryset_class = classObj._meta.get('queryset_class', QuerySet)
+    return queryset_class(classObj, history_collection(classObj))
+
+# Raw query for documents retired before the given datetime. Documents
+# retired without a removeddate go by their modifieddate. Both branches
+# use TrackedAssignment's (iscurrent, removeddate, modifieddate) index.
+def retired_query(before):
+    return {'iscurrent': False,
+            '$or': [{'removeddate': {'$lt': before}},
+                    {'removeddate': None,
+                     'modifieddate': {'$lt': before}}]}
+
+# Move the documents of classObj's collection retired before `before` to
+# its history collection, batchsize at a time, creating the history
+# collection's index on `keys` (db field, direction) pairs, if given.
+# Each batch is upserted into the history before it's deleted from the
+# live collection, so an interrupted run can simply be repeated. Calls
+# progress(moved, seconds) after each batch and returns the number of
+# documents moved.
+def archive_class(classObj, before, batchsize=1000, keys=None,
+                  progress=None):
+    live = classObj._get_collection()
+    history = history_collection(classObj)
+    if keys:
+        history.create_index(keys)
+    query = retired_query(before)
+    moved = 0
+    start = time.monotonic()
+    while True:
+        docs = list(live.find(query).limit(batchsize))
+        if len(docs) == 0:
+            break
+        history.bulk_write([ReplaceOne({'_id': doc['_id']}, doc,
+                                       upsert=True) for doc in docs],
+                           ordered=False)
+        ids = [doc['_id'] for doc in docs]
+        result = live.delete_many(dict(query, _id={'$in': ids}))
+        moved += result.deleted_count
+        if progress is not None:
+            progress(moved, time.monotonic() - start)
+    return moved
+
+# Archive every collection among classes once (subclasses sharing a
+# collection are archived with it). keys(classObj) gives the history
+# index for a class. Returns {class name: documents moved}.
+def archive_all(classes, before, batchsize=1000, keys=None,
+                progress=None):
+    counts = dict()
+    done = set()
+    for classObj in classes:
+        name = classObj._get_collection_name()
+        if name in done or 'iscurrent' not in classObj._fields:
+            continue
+        done.add(name)
+        counts[classObj.__name__] = archive_class(
+                classObj, before, batchsize,
+                keys(classObj) if keys is not None else None,
+                progress)
+    return counts
@@ -0,0 +1,257 @@
+# benchmark.py
+#
+# Benchmarks for the blueprint's hot paths. Builds a throwaway Flask app
+# against mongomock or a local mongod, fills it with synthetic users,
+# role assignments, tracked items and files, drives the routes through
+# the Flask test client, and reports latency percentiles, MongoDB
+# commands per call and peak Python memory. Results can be saved as a
+# baseline and later runs compared against it.
+#
+#   python -m mongomanager.benchmark --scale 100k --save baseline.json
+#   python -m mongomanager.benchmark --scale 100k --compare baseline.json
+#
+import os, sys, io, json, time, types, random, shutil, argparse
+import tempfile, tracemalloc
+import bson
+from datetime import datetime, timedelta
+from pymongo import monitoring
+
+SCALES = {'1k': 1000, '10k': 10000, '100k': 100000, '1M': 1000000}
+BATCH = 10000
+
+# Counts every MongoDB command. mongomock doesn't publish command events,
+# so query counts are only reported against a real mongod.
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+    def started(self, event):
+        self.count += 1
+    def succeeded(self, event):
+        pass
+    def failed(self, event):
+        pass
+
+commandCounter = CommandCounter()
+monitoring.register(commandCounter)
+
+# The blueprint imports the application's `database` module. Provide
+# one built from mongomanager.database plus a named item class.
+def install_database():
+    import mongoengine as me
+    import mongomanager.database as mmdb
+    module = types.ModuleType('database')
+    module.__dict__.update((key, value) for key, value
+                           in vars(mmdb).items()
+                           if not key.startswith('__'))
+    class BenchItem(mmdb.TrackedAssignment):
+        name = me.StringField(required=True)
+        meta = {'indexes': [('-iscurrent', '+name', '+id')]}
+    module.BenchItem = BenchItem
+    sys.modules['database'] = module
+    return module
+
+def make_app(host, dbname):
+    from flask import Flask
+    db = install_database()
+    from mongomanager import mongomanager as mm
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'benchmark'
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['MONGODB_SETTINGS'] = {'db': dbname, 'host': host}
+    db.eng.init_app(app)
+    app.register_blueprint(mm.mongomanager)
+    return app, db
+
+def insert_batches(classObj, docs):
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= BATCH:
+            classObj.objects.insert(batch, load_bulk=False)
+            batch = []
+    if len(batch) > 0:
+        classObj.objects.insert(batch, load_bulk=False)
+
+# Fill the database with n items, n/100 users with three role
+# assignments each (a third retired), and n/10 small files.
+def populate(db, n, basepath):
+    for classObj in (db.User, db.RoleAssignment, db.File, db.BenchItem):
+        classObj.drop_collection()
+        classObj.ensure_indexes()
+    start = datetime.utcnow() - timedelta(days=365)
+    admin = db.User(username='admin', firstname='Bench', lastname='Admin',
+                    email='admin@example.com', passwordhash='-',
+                    id=bson.ObjectId())
+    admin.addedby = admin
+    admin.save()
+    role = db.RoleAssignment(role='admin', user=admin, addedby=admin)
+    role.save()
+    admin.update(push__roleassignments=role)
+    users = [db.User(username='user%d' % i, firstname='First%d' % i,
+                     lastname='Last%d' % i, email='user%d@example.com' % i,
+                     passwordhash='-', addedby=admin,
+                     addeddate=start + timedelta(minutes=i))
+             for i in range(max(10, n // 100))]
+    insert_batches(db.User, users)
+    userids = [user.id for user in db.User.objects().only('id')]
+    insert_batches(db.RoleAssignment, (
+            db.RoleAssignment(role='role%d' % (i % 7), user=userid,
+                              addedby=admin, iscurrent=(i % 3 != 0),
+                              addeddate=start + timedelta(seconds=i))
+            for i, userid in enumerate(userids*3)))
+    insert_batches(db.BenchItem, (
+            db.BenchItem(name='item%08d' % random.randrange(10*n),
+                         addedby=random.choice(userids),
+                         iscurrent=(i % 4 != 0),
+                         addeddate=start + timedelta(seconds=i))
+            for i in range(n)))
+    files = []
+    for i in range(max(10, n // 10)):
+        fileObj = db.File(addedby=admin, basepath=basepath,
+                          filetype='x.json')
+        tempname, dataHash, size = fileObj.spoolfile(io.BytesIO(
+                json.dumps({'file': i, 'data': list(range(i % 100))})
+                    .encode('utf-8')))
+        fileObj.placefile(tempname, dataHash, size)
+        files.append(fileObj)
+    insert_batches(db.File, files)
+    return admin
+
+def measure(call, repeat):
+    for i in range(2):
+        call()
+    latencies = []
+    commands = commandCounter.count
+    for i in range(repeat):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    commands = (commandCounter.count - commands) / float(repeat)
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies.sort()
+    def percentile(q):
+        return latencies[min(len(latencies) - 1, int(q*len(latencies)))]
+    return dict(mean=sum(latencies)/len(latencies), p50=percentile(0.5),
+                p95=percentile(0.95), p99=percentile(0.99),
+                queries=commands, peak=peak)
+
+# The scenarios: (name, callable). Calls fail loudly unless they succeed,
+# so a redirect to /login or /nopermission is never timed as a result.
+def scenarios(app, db, admin, basepath):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['userid'] = str(admin.id)
+
+    def get(url, status=200, headers=None):
+        def call():
+            response = client.get(url, headers=headers)
+            if response.status_code != status:
+                raise RuntimeError('%s returned %d, expected %d' %
+                                   (url, response.status_code, status))
+            return response
+        return call
+
+    with app.test_request_context():
+        from mongomanager import mongomanager as mm
+        keys = mm.sort_keys(db.BenchItem)
+        middle = (db.BenchItem.objects()
+                  .order_by(*mm.sort_order(keys))
+                  .skip(db.BenchItem.objects.count() // 2).first())
+        cursor = mm.encode_cursor(middle, keys)
+    fileObj = db.File.objects().first()
+    user = db.User.objects(username__ne='admin').first()
+
+    def write():
+        writer = db.File(addedby=admin, basepath=basepath, filetype='bin')
+        if not writer.write_stream(io.BytesIO(os.urandom(1024*1024))):
+            raise RuntimeError('File.write_stream failed')
+    def read():
+        if fileObj.read() is None:
+            raise RuntimeError('File.read failed')
+
+    return [('requires_perm (/collections)', get('/collections')),
+            ('collection first page', get('/collection/BenchItem')),
+            ('collection middle page',
+             get('/collection/BenchItem?after=' + cursor)),
+            ('collection RoleAssignment',
+             get('/collection/RoleAssignment')),
+            ('object User', get('/collection/User/%s' % user.id)),
+            ('roles', get('/roles')),
+            ('render_directory', get('/dir' + basepath)),
+            ('getfile', get('/getfile/%s' % fileObj.id)),
+            ('getfile range', get('/getfile/%s' % fileObj.id, 206,
+                                  {'Range': 'bytes=0-1023'})),
+            ('showfile json', get('/showfile/%s' % fileObj.id)),
+            ('File.write_stream 1MB', write),
+            ('File.read', read)]
+
+def report(results, baseline=None, threshold=0.2):
+    regressions = []
+    print('%-32s %9s %9s %9s %9s %8s %10s' % ('scenario', 'mean ms',
+          'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'peak KB'))
+    for name, result in results.items():
+        line = '%-32s %9.2f %9.2f %9.2f %9.2f %8.1f %10.0f' % (
+                name, result['mean']*1000, result['p50']*1000,
+                result['p95']*1000, result['p99']*1000,
+                result['queries'], result['peak']/1024.0)
+        if baseline is not None and name in baseline:
+            before = baseline[name]
+            change = (result['p50'] - before['p50'])/before['p50']
+            line += '  p50 %+.0f%%' % (change*100)
+            if change > threshold:
+                regressions.append(name + ': p50 %+.0f%%' % (change*100))
+            if result['queries'] > before['queries']:
+                line += ' queries %+.1f' % (result['queries'] -
+                                            before['queries'])
+                regressions.append(name + ': %.1f -> %.1f queries' %
+                                   (before['queries'], result['queries']))
+        print(line)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Benchmark the mongomanager blueprint.')
+    parser.add_argument('--host', default='mongomock://localhost',
+                        help='MongoDB URI (default: mongomock)')
+    parser.add_argument('--db', default='mongomanager_benchmark',
+                        help='Database name; it is dropped and refilled.')
+    parser.add_argument('--scale', default='1k', choices=sorted(SCALES))
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--save', help='Save the results as a baseline.')
+    parser.add_argument('--compare', help='Compare against a baseline.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed p50 slowdown against the baseline.')
+    args = parser.parse_args(argv)
+
+    app, db = make_app(args.host, args.db)
+    basepath = tempfile.mkdtemp(prefix='mongomanager-benchmark-')
+    try:
+        with app.app_context():
+            start = time.perf_counter()
+            admin = populate(db, SCALES[args.scale], basepath)
+            print('Populated %s in %.1f s' %
+                  (args.scale, time.perf_counter() - start))
+            results = dict()
+            for name, call in scenarios(app, db, admin, basepath):
+                results[name] = measure(call, args.repeat)
+    finally:
+        shutil.rmtree(basepath, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if len(regressions) > 0:
+        print('Regressions:\n  ' + '\n  '.join(regressions))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+# cache.py
+#
+# Small thread-safe LRU cache with per-entry expiry, shared by the
+# blueprint for values that are expensive to look up in Mongo, and
+# shared on-disk and Redis caches that can sit behind it.
+#
+import os, time, shutil, hashlib, tempfile, threading
+from collections import OrderedDict
+
+_missing = object()
+
+class TTLCache(object):
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is not _missing:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, _missing)
+        return None if entry is _missing else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+# Shared cache of text values in a directory, one file per key. Each
+# file's modification time is set to when it expires. Several processes
+# (or hosts, on a shared filesystem) can use the same directory. Every
+# maxsize/SWEEP_DIVISOR sets, a sweep removes expired entries and then
+# the ones closest to expiry, down to maxsize.
+class DiskCache(object):
+    SWEEP_DIVISOR = 10
+    # Files being written start with this, and are left to the sweep 
+    # for an hour if a writer dies
+    TEMP_PREFIX = '.tmp'
+    TEMP_AGE = 3600
+
+    def __init__(self, path, ttl=3600, maxsize=10000):
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._sets = 0
+        self._lock = threading.Lock()
+
+    def filename(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def get(self, key, default=None):
+        filename = self.filename(key)
+        try:
+            if os.path.getmtime(filename) < time.time():
+                return default
+            with open(filename, 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return default
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        filename = self.filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, tempname = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                        prefix=self.TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(value)
+            now = time.time()
+            os.utime(tempname, (now, now + ttl))
+            os.replace(tempname, filename)
+        finally:
+            if os.path.exists(tempname):
+                os.remove(tempname)
+        with self._lock:
+            self._sets += 1
+            sweep = self._sets >= max(1, self.maxsize//self.SWEEP_DIVISOR)
+            if sweep:
+                self._sets = 0
+        if sweep:
+            self.sweep()
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    # Remove expired entries, then the entries closest to expiry beyond
+    # maxsize
+    def sweep(self):
+        now = time.time()
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                try:
+                    expires = os.path.getmtime(filename)
+                except OSError:
+                    continue
+                if name.startswith(self.TEMP_PREFIX):
+                    if expires < now - self.TEMP_AGE:
+                        self._remove(filename)
+                elif expires < now:
+                    self._remove(filename)
+                else:
+                    entries.append((expires, filename))
+        if len(entries) > self.maxsize:
+            entries.sort()
+            for expires, filename in entries[:len(entries) - self.maxsize]:
+                self._remove(filename)
+
+    def pop(self, key):
+        self._remove(self.filename(key))
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+# Shared cache of text values in Redis (or anything speaking its
+# protocol). Needs the redis package.
+class RedisCache(object):
+    def __init__(self, url, ttl=3600, prefix='mongomanager:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def name(self, key):
+        return (self.prefix + 
+                hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+    def get(self, key, default=None):
+        value = self.client.get(self.name(key))
+        return default if value is None else value.decode('utf-8')
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.name(key), value.encode('utf-8'), 
+                        ex=ttl or self.ttl)
+
+    def pop(self, key):
+        self.client.delete(self.name(key))
+
+    def clear(self):
+        for name in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(name)
+
+# An in-process TTLCache in front of an optional shared cache. Values 
+# found in the shared cache are copied into the local one.
+class TieredCache(object):
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self.local.get(key, _missing)
+        if value is _missing and self.shared is not None:
+            value = self.shared.get(key, _missing)
+            if value is not _missing:
+                self.local.set(key, value)
+        if value is _missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def pop(self, key):
+        value = self.local.pop(key)
+        if self.shared is not None:
+            self.shared.pop(key)
+        return value
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def __len__(self):
+        return len(self.local)
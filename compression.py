@@ -0,0 +1,79 @@
+# compression.py
+#
+# Compression at rest for the File store. Compressed blobs are stored as
+# <getfilename()>.gz or .zst next to where the plain blob would be, and
+# keep the hashstring of their uncompressed contents. zstd needs the
+# zstandard package; gzip is always available.
+#
+import os, gzip, shutil, struct
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNKSIZE = 1024*1024
+# Encoding name (as in File.encoding and HTTP Content-Encoding): suffix
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# A stored blob's name without its compression suffix
+def strip_suffix(filename):
+    for suffix in SUFFIXES.values():
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+def available(encoding):
+    if encoding == 'zstd':
+        return zstandard is not None
+    return encoding in SUFFIXES
+
+# zstd where it's installed, otherwise gzip
+def default_encoding():
+    return 'zstd' if available('zstd') else 'gzip'
+
+# Compress the file srcname (of size bytes) into the file dstname
+def compress(srcname, dstname, encoding, size=None):
+    with open(srcname, 'rb') as src, open(dstname, 'wb') as dst:
+        if encoding == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            compressor.copy_stream(src, dst, size=size if size else -1,
+                                   read_size=CHUNKSIZE,
+                                   write_size=CHUNKSIZE)
+        else:
+            with gzip.GzipFile(fileobj=dst, mode='wb',
+                               compresslevel=GZIP_LEVEL, mtime=0) as out:
+                shutil.copyfileobj(src, out, CHUNKSIZE)
+
+# A binary file object reading the uncompressed contents of filename
+def open_decompressed(filename, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(
+                open(filename, 'rb'), read_size=CHUNKSIZE,
+                closefd=True)
+    elif encoding == 'gzip':
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+# The uncompressed size recorded in a compressed file, or None if it
+# isn't recorded. gzip only keeps it modulo 2**32.
+def stored_size(filename, encoding):
+    if encoding == 'gzip':
+        with open(filename, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+    elif encoding == 'zstd':
+        with open(filename, 'rb') as f:
+            size = zstandard.frame_content_size(f.read(18))
+        return size if size >= 0 else None
+    return os.path.getsize(filename)
+
+# Whether a stored size matches the size of the uncompressed contents
+def size_matches(stored, size, encoding):
+    if stored is None:
+        return True
+    if encoding == 'gzip':
+        return stored == size % 2**32
+    return stored == size
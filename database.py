@@ -6,14 +6,54 @@ from pymongo.errors import DuplicateKeyError
 from mongoengine import NotUniqueError
 from datetime import datetime
 import os
+import io
 import hashlib
 import logging
+import tempfile
+import traceback
+import mongomanager.segments as segments
+import mongomanager.compression as compression
 
 eng = MongoEngine()
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('mongomanager')
 
+# Size of the chunks read while hashing, copying and comparing files
+CHUNKSIZE = 1024*1024
+
+# Mode of the files the store creates, as open() would create them under
+# the process umask (read once, setting it is the only way to read it).
+# tempfile.mkstemp creates files 0600, which a web server running as 
+# another user (see MONGOMANAGER_ACCEL_REDIRECT) couldn't read.
+_umask = os.umask(0o022)
+os.umask(_umask)
+FILEMODE = 0o666 & ~_umask
+
+# Read size bytes, or up to the end of the file. Decompressing readers
+# may return less than asked for before the end.
+def readchunk(f, size):
+    data = f.read(size)
+    while 0 < len(data) < size:
+        more = f.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+# Compare two files chunk by chunk, decompressing the first if it's 
+# stored with an encoding
+def samecontents(filename1, filename2, chunksize=CHUNKSIZE, 
+                 encoding1=''):
+    with compression.open_decompressed(filename1, encoding1) as f1, \
+         open(filename2, 'rb') as f2:
+        while True:
+            chunk1 = readchunk(f1, chunksize)
+            chunk2 = readchunk(f2, chunksize)
+            if chunk1 != chunk2:
+                return False
+            if not chunk1:
+                return True
+
 class TrackedAssignment(me.Document):
     addedby = me.ReferenceField('User', required=True)
     addeddate = me.DateTimeField(required=True, default=datetime.utcnow)
@@ -21,17 +61,39 @@ class TrackedAssignment(me.Document):
     removedby = me.ReferenceField('User', required=False)
     removeddate = me.DateTimeField(required=False)
     modifieddate = me.DateTimeField(required=True, default=datetime.utcnow)
+    # Every collection page sorts on iscurrent then addeddate (or name, 
+    # see the README), with _id to break ties. The collections page 
+    # looks up the latest modifieddate. Archiving finds retired documents
+    # with a raw query (archive.retired_query) that has no _cls.
     meta = {'allow_inheritance': True,
-            'abstract': True}
+            'abstract': True,
+            'indexes': [('-iscurrent', '+addeddate', '+id'),
+                        '-modifieddate',
+                        {'fields': ['iscurrent', 'removeddate', 
+                                    'modifieddate'],
+                         'cls': False}]}
     def update(self, *args, **kwargs):
         result = super(TrackedAssignment, self).update(
                 modifieddate=datetime.utcnow(), *args, **kwargs)
         return result
 
+    # Saving changes to an existing document stamps modifieddate too, so
+    # it can key caches of the rendered document.
+    def save(self, *args, **kwargs):
+        if (self.pk is not None and not self._created and 
+                len(self._get_changed_fields()) > 0):
+            self.modifieddate = datetime.utcnow()
+        return super(TrackedAssignment, self).save(*args, **kwargs)
+
 
 class RoleAssignment(TrackedAssignment):
     role = me.StringField(required=True)
     user = me.ReferenceField('User', required=True)
+    # Without the _cls prefix mongoengine gives indexes of inheriting 
+    # classes, so that the role matrix's $lookup and the raw queries of
+    # rolechanges.py, which match on user alone, can use it too.
+    meta = {'indexes': [{'fields': ['user', 'iscurrent', 'role'], 
+                         'cls': False}]}
 
 class User(TrackedAssignment):
     username     = me.StringField(required=True, unique=True)
@@ -41,6 +103,7 @@ class User(TrackedAssignment):
     passwordhash = me.StringField(required=True)
     roleassignments = me.ListField(me.ReferenceField(RoleAssignment), 
                     required=False, default=[])
+    meta = {'indexes': [('username', 'iscurrent')]}
 
 class File(TrackedAssignment):
     filetype   = me.StringField(required=True, default='')
@@ -48,7 +111,26 @@ class File(TrackedAssignment):
     basepath   = me.StringField(required=True, default='')
     filepath   = me.StringField(required=True, default='')
     filename   = me.StringField(required=True, default='')
+    # '' for the hashstring fan-out directories, 'segment' for objects
+    # packed into the basepath's segment files (see segments.py)
+    storage    = me.StringField(required=False, default='')
+    # '' when stored as is, or the compression ('gzip' or 'zstd', see 
+    # compression.py) of the stored bytes
+    encoding   = me.StringField(required=False, default='')
+    # The verifier and compaction look up hashstrings by basepath with 
+    # raw queries, without _cls
+    meta = {'indexes': [('filepath', 'filename'), 'hashstring', 
+                        'filename',
+                        {'fields': ['basepath', 'hashstring'], 
+                         'cls': False}]}
 
+    # Objects of up to this many bytes are packed into segment files
+    # rather than getting a file of their own. 0 disables segments.
+    segmentthreshold = 0
+    # Extensions of the filetypes compressed when stored, e.g. ('.json',)
+    # and the compression used for them
+    compresstypes = ()
+    compressencoding = compression.default_encoding()
 
     def getpath(self):
         fullpath = os.path.join(self.basepath,
@@ -60,51 +142,207 @@ class File(TrackedAssignment):
     def getfilename(self):
         return self.hashstring[6:]
 
-    def write(self, data):
-        dataHash = hashlib.sha256(data)
+    def gettemppath(self):
+        return os.path.join(self.basepath, '.tmp')
+
+    # Copy a file-like object (or an iterator of chunks) into a temporary
+    # file inside the store, hashing it on the way so that memory use 
+    # doesn't depend on the size of the data.
+    def spoolfile(self, stream, chunksize=CHUNKSIZE):
+        if hasattr(stream, 'read'):
+            stream = iter(lambda read=stream.read: read(chunksize), b'')
+        temppath = self.gettemppath()
+        if not os.path.exists(temppath):
+            os.makedirs(temppath, exist_ok=True)
+        fd, tempname = tempfile.mkstemp(dir=temppath)
+        os.fchmod(fd, FILEMODE)
+        dataHash = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in stream:
+                dataHash.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        return tempname, dataHash, size
+
+    # Move a spooled temporary file into its place in the hashstring
+    # fan-out directories, compressed if its filetype is one of 
+    # compresstypes. A file already stored under the same hash (plain or
+    # compressed) is taken as a duplicate if its size matches (and, with
+    # compare=True, its contents match chunk by chunk).
+    def placefile(self, tempname, dataHash, size, compare=False):
+        if 0 < size <= self.segmentthreshold:
+            return self.placesegment(tempname, dataHash, size, compare)
+        self.storage = ''
+        encoding = self.compressencoding if self.compressible() else ''
+        packedname = None
         try:
             while True:
                 self.hashstring=dataHash.hexdigest()
                 self.filepath = self.getpath()
                 if not os.path.exists(self.filepath):
-                    os.makedirs(self.filepath)
+                    os.makedirs(self.filepath, exist_ok=True)
                 self.filename = self.getfilename()
                 fullfilename = os.path.join(self.filepath, 
                                             self.filename)
                 logger.debug('Filename: ' + fullfilename)
+                existing = self.findstored()
                 # If the filename exists already
-                if os.path.exists(fullfilename):
-                    with open(fullfilename,'rb') as f:
-                        existingData = f.read()
+                if existing is not None:
+                    storedname, storedencoding = existing
                     # If it's the same file, keep the hashstring
-                    if data == existingData:
+                    if (compression.size_matches(
+                                compression.stored_size(storedname, 
+                                                        storedencoding),
+                                size, storedencoding) and 
+                            (not compare or 
+                             samecontents(storedname, tempname, 
+                                          encoding1=storedencoding))):
                         logger.debug('File duplicate found, ' +
                                      'linking to duplicate.')
-                        self.iscurrent = True
-                        self.save()
-                        return True
-                    # If it's not identical increment the hash and try again
+                        self.encoding = storedencoding
+                        os.remove(tempname)
+                        return
+                    # If it's not identical increment the hash and try 
+                    # again
                     else:
-                        logger.deebug('File hash collision, ' + 
+                        logger.debug('File hash collision, ' + 
                                       'incrementing hash')
                         dataHash.update('1'.encode('utf-8'))
+                        continue
                 # If we haven't already stored a file with that hash, 
-                # save it.
-                else:
-                    logger.debug('Writing new file.')
-                    with open(fullfilename,'wb+') as f:
-                        f.write(data)
-                    self.iscurrent = True
-                    self.save()
-                    return True
+                # move it into place. Linking never replaces an existing
+                # file, so concurrent writers of the same hash are safe.
+                logger.debug('Writing new file.')
+                self.encoding = encoding
+                sourcename = tempname
+                if encoding:
+                    if packedname is None:
+                        packedname = tempname + compression.SUFFIXES[encoding]
+                        compression.compress(tempname, packedname, 
+                                             encoding, size)
+                    sourcename = packedname
+                    fullfilename += compression.SUFFIXES[encoding]
+                try:
+                    os.link(sourcename, fullfilename)
+                except FileExistsError:
+                    # Another writer got there first, check it again
+                    continue
+                except OSError:
+                    # No hard links on this filesystem
+                    os.rename(sourcename, fullfilename)
+                    if sourcename == tempname:
+                        return
+                os.remove(tempname)
+                return
+        finally:
+            if packedname is not None and os.path.exists(packedname):
+                os.remove(packedname)
+
+    # The stored blob for the hashstring as (filename, encoding), or None
+    def findstored(self):
+        fullfilename = os.path.join(self.getpath(), self.getfilename())
+        for encoding in [''] + sorted(compression.SUFFIXES):
+            storedname = fullfilename + compression.SUFFIXES.get(encoding, 
+                                                                 '')
+            if os.path.exists(storedname):
+                return storedname, encoding
+        return None
+
+    # Whether files of this filetype are compressed when stored
+    def compressible(self):
+        stem, ext = os.path.splitext(self.filetype or '')
+        if ext == '' and stem != '':
+            ext = '.' + stem
+        return (ext.lower() in self.compresstypes and 
+                compression.available(self.compressencoding))
+
+    # Append a spooled temporary file to the basepath's segment store,
+    # with the same duplicate and collision handling as placefile. The
+    # filepath and filename are still recorded, so a segment object can
+    # later be unpacked into the fan-out directories.
+    def placesegment(self, tempname, dataHash, size, compare=False):
+        store = segments.get_store(self.basepath)
+        self.storage = 'segment'
+        while True:
+            self.hashstring=dataHash.hexdigest()
+            self.filepath = self.getpath()
+            self.filename = self.getfilename()
+            stored, length = store.put(self.hashstring, tempname, size)
+            if stored:
+                logger.debug('Writing new segment object.')
+            elif (length == size and 
+                    (not compare or 
+                     store.samecontents(self.hashstring, tempname))):
+                logger.debug('Segment object duplicate found.')
+            else:
+                logger.debug('Segment hash collision, incrementing hash')
+                dataHash.update('1'.encode('utf-8'))
+                continue
+            os.remove(tempname)
+            return
+
+    # A binary file object over the stored contents
+    def open(self):
+        if self.storage == 'segment':
+            return segments.get_store(self.basepath).open(self.hashstring)
+        return compression.open_decompressed(self.getstoredname(), 
+                                             self.encoding)
+
+    # The file holding the stored (possibly compressed) bytes of a blob
+    def getstoredname(self):
+        return os.path.join(self.getpath(), self.getfilename() + 
+                            compression.SUFFIXES.get(self.encoding, ''))
+
+    # Store an existing file, hashing it in place. With link=True the 
+    # file is hard linked into the store instead of copied. Doesn't 
+    # save the document.
+    def storefile(self, srcname, link=False, chunksize=CHUNKSIZE):
+        if not link:
+            with open(srcname, 'rb') as f:
+                tempname, dataHash, size = self.spoolfile(f, chunksize)
+        else:
+            dataHash = hashlib.sha256()
+            size = 0
+            with open(srcname, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunksize), b''):
+                    dataHash.update(chunk)
+                    size += len(chunk)
+            temppath = self.gettemppath()
+            if not os.path.exists(temppath):
+                os.makedirs(temppath, exist_ok=True)
+            tempname = os.path.join(temppath, 
+                                    'link-' + dataHash.hexdigest() + '-' +
+                                    str(os.getpid()))
+            os.link(srcname, tempname)
+        try:
+            self.placefile(tempname, dataHash, size)
+        finally:
+            if os.path.exists(tempname):
+                os.remove(tempname)
+        return size
+
+    # Store data read from a file-like object or an iterator of chunks.
+    def write_stream(self, stream, compare=False, chunksize=CHUNKSIZE):
+        tempname = None
+        try:
+            tempname, dataHash, size = self.spoolfile(stream, chunksize)
+            self.placefile(tempname, dataHash, size, compare=compare)
+            self.iscurrent = True
+            self.save()
+            return True
         except:         
             print(traceback.print_exc())
+        finally:
+            if tempname is not None and os.path.exists(tempname):
+                os.remove(tempname)
+
+    def write(self, data):
+        return self.write_stream(io.BytesIO(data), compare=True)
 
     def read(self):
         try:
-            fullpath = self.getpath()
-            filename = os.path.join(fullpath, self.getfilename())
-            with open(filename,'rb') as f:
+            with self.open() as f:
                 data = f.read()
             return data
         except:     
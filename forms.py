@@ -1,5 +1,6 @@
 # forms.py
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import PasswordField, StringField, SelectField, HiddenField
 from wtforms import validators
 
@@ -34,7 +35,10 @@ class RoleForm(FlaskForm):
                           [Alphanumeric, 
                            validators.Optional(strip_whitespace=False)])
 
+class BulkRoleForm(FlaskForm):
+    changes = FileField('Role changes (CSV or JSON):', [FileRequired()])
+
 class ItemForm(FlaskForm):
     additem = StringField('Item to add:')
-    remitem = SelectField('Item to remove:')
+    remitem = StringField('Item to remove:')
 
@@ -0,0 +1,114 @@
+# ingest.py
+#
+# Bulk ingest of existing directory trees into the File store. Files are
+# hashed and copied (or hard linked) into the basepath fan-out layout by
+# a pool of worker processes, and their File documents are inserted in
+# batches. Ingested paths are appended to an optional state file so an
+# interrupted run can be resumed. A File document is only inserted if
+# there isn't a current one for the same stored object and filetype
+# already, so resuming after the insert of a batch but before its state
+# was written doesn't duplicate it.
+#
+import os, time, traceback
+import multiprocessing
+
+import database as db
+
+# Walk a directory tree, yielding the full name of every file in it
+def walk_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            yield os.path.join(dirpath, filename)
+
+# Worker: store one file and return what its File document needs.
+# Errors are returned rather than raised so one bad file doesn't stop
+# the run.
+def _store(args):
+    srcname, fileClass, basepath, link = args
+    try:
+        stem, ext = os.path.splitext(srcname)
+        fileObj = fileClass(basepath=basepath, filetype=ext[1:])
+        size = fileObj.storefile(srcname, link=link)
+        return dict(srcname=srcname, size=size,
+                    hashstring=fileObj.hashstring,
+                    filepath=fileObj.filepath,
+                    filename=fileObj.filename,
+                    storage=fileObj.storage,
+                    encoding=fileObj.encoding)
+    except Exception:
+        return dict(srcname=srcname, error=traceback.format_exc())
+
+# Ingest every file under root into the store at basepath, recording
+# user as addedby. Calls progress(files, bytes, errors, seconds) after
+# each batch. Returns (files, bytes, errors).
+def ingest_tree(root, basepath, user, fileClass=None, processes=None,
+                link=False, batchsize=1000, statefile=None, progress=None):
+    if fileClass is None:
+        fileClass = db.File
+    done = set()
+    if statefile is not None and os.path.exists(statefile):
+        with open(statefile, 'r') as f:
+            done = set(line.rstrip('\n') for line in f)
+    state = open(statefile, 'a') if statefile is not None else None
+    files = 0
+    nbytes = 0
+    errors = 0
+    start = time.monotonic()
+    batch = []
+
+    def flush():
+        if len(batch) > 0:
+            existing = set(fileClass.objects(
+                    basepath=basepath, iscurrent=True,
+                    hashstring__in=list(set(doc.hashstring for srcname, doc 
+                                            in batch)))
+                    .scalar('hashstring', 'filename', 'filetype'))
+            docs = []
+            for srcname, doc in batch:
+                key = (doc.hashstring, doc.filename, doc.filetype)
+                if key not in existing:
+                    existing.add(key)
+                    docs.append(doc)
+            if len(docs) > 0:
+                fileClass.objects.insert(docs, load_bulk=False)
+            if state is not None:
+                state.write(''.join(srcname + '\n'
+                                    for srcname, doc in batch))
+                state.flush()
+            del batch[:]
+        if progress is not None:
+            progress(files, nbytes, errors, time.monotonic() - start)
+
+    tasks = ((srcname, fileClass, basepath, link)
+             for srcname in walk_files(root) if srcname not in done)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(_store, tasks, chunksize=16):
+            if 'error' in result:
+                errors += 1
+                db.logger.error('Unable to ingest ' + result['srcname'] +
+                                '\n' + result['error'])
+                continue
+            stem, ext = os.path.splitext(result['srcname'])
+            doc = fileClass(addedby=user,
+                            filetype=ext[1:],
+                            hashstring=result['hashstring'],
+                            basepath=basepath,
+                            filepath=result['filepath'],
+                            filename=result['filename'],
+                            storage=result['storage'],
+                            encoding=result['encoding'],
+                            iscurrent=True)
+            batch.append((result['srcname'], doc))
+            files += 1
+            nbytes += result['size']
+            if len(batch) >= batchsize:
+                flush()
+        flush()
+    finally:
+        pool.close()
+        pool.join()
+        if state is not None:
+            state.close()
+    return files, nbytes, errors
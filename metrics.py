@@ -0,0 +1,168 @@
+# metrics.py
+#
+# Per-request MongoDB query instrumentation. A pymongo command listener
+# counts and times the commands issued while handling each request, and
+# per-route latency and query count histograms are kept for the metrics
+# page and for Prometheus.
+#
+import time, threading, logging
+from pymongo import monitoring
+from flask import g, request, current_app, has_request_context
+
+logger = logging.getLogger('mongomanager')
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0) # seconds
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1) # The last is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    # Upper bound of the bucket holding the q'th quantile
+    def quantile(self, q):
+        target = q*self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return float('inf')
+
+    # (upper bound, cumulative count) pairs, ending with +Inf
+    def cumulative(self):
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),),
+                                self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+# Latency and query count histograms by endpoint
+class RouteMetrics(object):
+    def __init__(self):
+        self.routes = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, seconds, queries, querySeconds):
+        with self._lock:
+            if endpoint not in self.routes:
+                self.routes[endpoint] = dict(
+                        latency=Histogram(LATENCY_BUCKETS),
+                        queries=Histogram(QUERY_BUCKETS),
+                        querytime=Histogram(LATENCY_BUCKETS))
+            route = self.routes[endpoint]
+            route['latency'].observe(seconds)
+            route['queries'].observe(queries)
+            route['querytime'].observe(querySeconds)
+
+    def snapshot(self):
+        with self._lock:
+            return sorted(self.routes.items())
+
+routeMetrics = RouteMetrics()
+
+# Counts and times the commands issued during a request, and logs those
+# slower than MONGOMANAGER_SLOW_QUERY_MS along with the view that issued
+# them. pymongo publishes the events on the thread running the command.
+class CommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        if has_request_context():
+            collection = event.command.get(event.command_name)
+            g.setdefault('mm_commands', dict())[event.request_id] = (
+                    collection if isinstance(collection, str) else '')
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        if not has_request_context():
+            return
+        duration = event.duration_micros/1e6
+        g.mm_querycount = g.get('mm_querycount', 0) + 1
+        g.mm_querytime = g.get('mm_querytime', 0.0) + duration
+        collection = g.get('mm_commands', dict()).pop(event.request_id, '')
+        threshold = current_app.config.get('MONGOMANAGER_SLOW_QUERY_MS')
+        if threshold is not None and duration*1000 >= threshold:
+            logger.warning('Slow query: %s %s took %.1f ms in view %s',
+                           event.command_name, collection,
+                           duration*1000, request.endpoint)
+
+# Register the listener with pymongo. Must run before the MongoClient
+# is created, i.e. before eng.init_app(app).
+commandTimer = CommandTimer()
+monitoring.register(commandTimer)
+
+def start_request():
+    g.mm_start = time.perf_counter()
+
+# Record the request in the route histograms and report the time spent
+# in the database with a Server-Timing header.
+def finish_request(response):
+    if 'mm_start' not in g:
+        return response
+    seconds = time.perf_counter() - g.mm_start
+    queries = g.get('mm_querycount', 0)
+    querySeconds = g.get('mm_querytime', 0.0)
+    routeMetrics.observe(request.endpoint or 'unknown', seconds, queries,
+                         querySeconds)
+    response.headers.add('Server-Timing',
+                         'db;dur=%.1f;desc="%d queries"' %
+                         (querySeconds*1000, queries))
+    response.headers.add('Server-Timing', 'app;dur=%.1f' % (seconds*1000))
+    return response
+
+# Route metrics (and any named caches' hit rates) in the Prometheus
+# text exposition format.
+def prometheus_text(caches=None):
+    lines = []
+    histograms = [('latency', 'mongomanager_request_duration_seconds',
+                   'Request latency by endpoint.'),
+                  ('queries', 'mongomanager_request_queries',
+                   'MongoDB commands per request by endpoint.'),
+                  ('querytime', 'mongomanager_request_query_seconds',
+                   'Time in MongoDB commands per request by endpoint.')]
+    routes = routeMetrics.snapshot()
+    for key, name, help in histograms:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s histogram' % name)
+        for endpoint, route in routes:
+            histogram = route[key]
+            for bound, count in histogram.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket{endpoint="%s",le="%s"} %d' %
+                             (name, endpoint, le, count))
+            lines.append('%s_sum{endpoint="%s"} %r' %
+                         (name, endpoint, histogram.sum))
+            lines.append('%s_count{endpoint="%s"} %d' %
+                         (name, endpoint, histogram.count))
+    if caches:
+        for name, help in [('hits', 'Cache hits.'),
+                           ('misses', 'Cache misses.')]:
+            lines.append('# HELP mongomanager_cache_%s_total %s' %
+                         (name, help))
+            lines.append('# TYPE mongomanager_cache_%s_total counter' %
+                         name)
+            for cacheName, cache in sorted(caches.items()):
+                lines.append('mongomanager_cache_%s_total{cache="%s"} %d' %
+                             (name, cacheName, getattr(cache, name)))
+    return '\n'.join(lines) + '\n'
@@ -3,18 +3,25 @@
 # Blueprint for password protected Mongo collections, 
 # with registration and login
 #
-import os, glob, sys, json, time, bson, random
-from functools import wraps
+import os, glob, sys, re, json, time, bson, random, base64, mimetypes
+import hmac, io, csv, zlib, threading, itertools
+from collections import OrderedDict
+import tempfile
+import bson.json_util
+from functools import wraps, cmp_to_key
 from os import environ as env
 from datetime import datetime, timedelta
 import pytz
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from mongoengine import NotUniqueError
 from flask import Flask, jsonify, redirect, request, make_response
 from flask import render_template, Blueprint
 from flask import session, url_for, flash, Response, abort
-from flask import send_from_directory
+from flask import send_from_directory, g, current_app
+from flask import stream_with_context, escape
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.wsgi import wrap_file
+import click
 
 # Register as a blueprint
 mongomanager = Blueprint('mongomanager', __name__,
@@ -24,13 +31,64 @@ mongomanager = Blueprint('mongomanager', __name__,
 import database as db # Import the application's database, 
                       # which should import mongomanager.database itself.
 import mongomanager.forms as forms
+from mongomanager.cache import TTLCache, TieredCache, DiskCache, RedisCache
+import mongomanager.preview as preview
+import mongomanager.ingest as ingest
+import mongomanager.metrics as metrics
+import mongomanager.thumbnails as thumbnails
+import mongomanager.segments as segments
+import mongomanager.archive as archive
+import mongomanager.rolechanges as rolechanges
+import mongomanager.search as search
+import mongomanager.verify as verify
+import mongomanager.compression as compression
+
+# Current roles for each user, shared across requests so that permission
+# checks on hot routes don't touch the database. Entries expire after
+# MONGOMANAGER_ROLE_CACHE_TTL seconds and are dropped whenever roles()
+# or register() changes a RoleAssignment.
+roleCache = TTLCache(maxsize=1024, ttl=60)
+
+# Returns the logged in User, loading it at most once per request.
+def get_current_user():
+    if 'mm_user' not in g:
+        g.mm_user = None
+        if 'userid' in session:
+            g.mm_user = db.User.objects(id=session['userid']).first()
+    return g.mm_user
+
+# Returns the set of current roles for the logged in user, looking in
+# the request, then the role cache, and only then the database.
+def get_current_roles():
+    if 'mm_roles' not in g:
+        userid = session.get('userid')
+        roles = roleCache.get(userid)
+        if roles is None:
+            roles = frozenset(db.RoleAssignment.objects(
+                        user=userid, iscurrent=True).scalar('role'))
+            roleCache.set(userid, roles, 
+                ttl=current_app.config.get('MONGOMANAGER_ROLE_CACHE_TTL'))
+        g.mm_roles = roles
+    return g.mm_roles
+
+# Drop cached roles for a user (or for everyone) after a RoleAssignment
+# changes.
+def invalidate_roles(userid=None):
+    if userid is None:
+        roleCache.clear()
+    else:
+        roleCache.pop(str(userid))
+    g.pop('mm_roles', None)
+
+# Count and time the database commands of every request
+mongomanager.before_app_request(metrics.start_request)
+mongomanager.after_app_request(metrics.finish_request)
 
 # Make user info available in all templates
 @mongomanager.app_context_processor
 def inject_user():
-    if 'userid' in session:
-        user = db.User.objects(id=session['userid']).first()
-    else:
+    user = get_current_user()
+    if user is None:
         user = dict()
         user['username'] = 'none'
         user['firstname'] = 'Not logged in'
@@ -58,10 +116,7 @@ def requires_perm(requiredRole):
             if 'userid' not in session:
                 session['requestpath'] = request.path
                 return redirect('/login')
-            user = db.User.objects(id=session['userid']).first()
-            validRoles = [roleAssignment.role for roleAssignment 
-                          in user.roleassignments if 
-                          roleAssignment.iscurrent]
+            validRoles = get_current_roles()
             if ((requiredRole not in validRoles) and 
                     ('admin' not in validRoles)):
                 session['requestpath'] = request.path
@@ -137,20 +192,20 @@ def register():
                             iscurrent = True)
                 newRole.save()
                 newUser.update(push__roleassignments=newRole)
+                invalidate_roles(newUser.id)
             return redirect('/login')
         else:
             form.username.errors.append('User already exists')
     return render_template('register.html', form=form)
 
-# Given a path and filename, find a link to the showfile page
-@requires_perm('admin')
-def link_to_file(filepath, filename):
-    if os.path.isfile(os.path.join(filepath, filename)):
-        item = db.File.objects(filepath=filepath, filename=filename).first()
-        if item is not None:
+# Build the link for a directory entry: indexed files link to their 
+# showfile page, and directories to their listing.
+def directory_link(filepath, filename, isfile, fileid=None):
+    if isfile:
+        if fileid is not None:
             linkURL = url_for('mongomanager.showfile', 
-                              id=str(item.id))
-            link = '<a href="'+linkURL+'">'+str(item.filename)+'</a>'
+                              id=str(fileid))
+            link = '<a href="'+linkURL+'">'+str(filename)+'</a>'
         else:
             link = str(filename) + ' [Not indexed]'
     else:
@@ -158,6 +213,18 @@ def link_to_file(filepath, filename):
                           path=os.path.join(filepath, filename))
         link = "<a href='"+linkURL+"'>"+str(filename)+"</a>"
     return link
+
+# Given a path and filename, find a link to the showfile page
+@requires_perm('admin')
+def link_to_file(filepath, filename):
+    if os.path.isfile(os.path.join(filepath, filename)):
+        item = db.File.objects(filepath=filepath, 
+                               filename=compression.strip_suffix(filename)
+                               ).first()
+        return directory_link(filepath, filename, True, 
+                              item.id if item is not None else None)
+    else:
+        return directory_link(filepath, filename, False)
 mongomanager.add_app_template_global(link_to_file)
 
 # Construct a link to the parent directory
@@ -169,20 +236,137 @@ def link_to_parent_dir(path):
     return link
 mongomanager.add_app_template_global(link_to_parent_dir)
 
+# Entries per page of a directory listing, overridable with 
+# MONGOMANAGER_DIR_PAGE_SIZE.
+DIR_PAGE_SIZE = 500
+
+# Sorted (name, isfile) listings by path, reused for a few seconds
+# (MONGOMANAGER_DIR_CACHE_TTL) as long as the directory's mtime hasn't
+# changed.
+dirCache = TTLCache(maxsize=256, ttl=10)
+
+def list_directory(path):
+    mtime = os.stat(path).st_mtime_ns
+    cached = dirCache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with os.scandir(path) as it:
+        entries = sorted((entry.name, entry.is_file()) for entry in it)
+    dirCache.set(path, (mtime, entries), 
+                 ttl=current_app.config.get('MONGOMANAGER_DIR_CACHE_TTL'))
+    return entries
+
 @mongomanager.route('/dir/<path:path>')
 @requires_perm('admin')
 def render_directory(path):
     path = '/' + path # Add the full root slash on
     # if os.path.realpath(path).startswith(SAFEPATH):
     if True:
-        pathItems = os.listdir(path)
+        pagesize = current_app.config.get('MONGOMANAGER_DIR_PAGE_SIZE', 
+                                          DIR_PAGE_SIZE)
+        page = max(0, request.args.get('page', 0, type=int))
+        entries = list_directory(path)
+        pageEntries = entries[page*pagesize:(page+1)*pagesize]
+        # Find which files on this page are indexed with a single query.
+        # Compressed blobs are indexed without their suffix.
+        filenames = [compression.strip_suffix(name) 
+                     for name, isfile in pageEntries if isfile]
+        fileids = dict()
+        if len(filenames) > 0:
+            for item in db.File.objects(filepath=path, 
+                                        filename__in=filenames
+                                        ).only('id', 'filename'):
+                fileids[item.filename] = item.id
+        pathLinks = [directory_link(path, name, isfile, 
+                                    fileids.get(compression.strip_suffix(name)))
+                     for name, isfile in pageEntries]
         return render_template('showdir.html', 
                                path=path, 
-                               pathItems=pathItems)
+                               pathLinks=pathLinks,
+                               page=page,
+                               lastPage=(page+1)*pagesize >= len(entries))
     else:
         session['requestpath'] = request.path
         return redirect('/nopermission')
 
+# Fields used as link text for referenced documents, in order of 
+# preference
+LINK_FIELDS = ['name', 'username', 'role']
+
+def link_field(classObj):
+    for key in LINK_FIELDS:
+        if key in classObj._fields.keys():
+            return key
+    return None
+
+# Resolve references, given as {collection: (classObj, set of ids)}, 
+# with a single $in query per collection that only fetches the link 
+# text. Ids not found are looked for in the history collection (see 
+# archive.py). Results are kept on the request keyed by (collection, id)
+# as (className, linkText); missing documents resolve to no link text.
+def resolve_references(wanted):
+    resolved = g.setdefault('mm_refs', dict())
+    for collection, (classObj, ids) in wanted.items():
+        ids = [id for id in ids if (collection, id) not in resolved]
+        if len(ids) == 0:
+            continue
+        key = link_field(classObj)
+        dbkey = classObj._fields[key].db_field if key else '_id'
+        missing = set(ids)
+        for doc in classObj._get_collection().find(
+                {'_id': {'$in': ids}}, {dbkey: 1}):
+            resolved[(collection, doc['_id'])] = (classObj.__name__,
+                                                  doc.get(dbkey))
+            missing.discard(doc['_id'])
+        if len(missing) > 0:
+            for doc in archive.history_collection(classObj).find(
+                    {'_id': {'$in': list(missing)}}, {dbkey: 1}):
+                resolved[(collection, doc['_id'])] = (classObj.__name__,
+                                                      doc.get(dbkey))
+                missing.discard(doc['_id'])
+        for id in missing:
+            resolved[(collection, id)] = (classObj.__name__, None)
+    return resolved
+
+# Prefetch stage for a page of documents loaded with no_dereference():
+# collect every referenced id per target class so that render_item can 
+# render the references without one lazy query per cell.
+def prefetch_references(items):
+    wanted = dict()
+    for item in items:
+        for key, field in item._fields.items():
+            values = item._data.get(key)
+            if isinstance(field, db.me.ListField):
+                field = field.field
+            else:
+                values = [values]
+            if not isinstance(field, db.me.ReferenceField) or not values:
+                continue
+            for value in values:
+                if isinstance(value, bson.DBRef):
+                    wanted.setdefault(value.collection, 
+                                      (field.document_type, set())
+                                      )[1].add(value.id)
+    return resolve_references(wanted)
+
+# Look up a single reference, resolving it on the spot if it wasn't 
+# prefetched.
+def lookup_reference(ref):
+    resolved = g.get('mm_refs', dict())
+    if (ref.collection, ref.id) not in resolved:
+        candidates = [item for item in document_classes()
+                      if item._meta.get('collection') == ref.collection]
+        if len(candidates) == 0:
+            return None, None
+        classObj = min(candidates, key=lambda item: len(item._class_name))
+        resolved = resolve_references({ref.collection: 
+                                       (classObj, set([ref.id]))})
+    return resolved[(ref.collection, ref.id)]
+
+# Display a UTC datetime in the server's timezone
+def format_datetime(item):
+    return pytz.utc.localize(item).astimezone().strftime("%m/%d/%Y %H:%M:%S")
+
 # Utility function for rendering reference fields as links
 @requires_perm('admin')
 def render_item(itemkey, item, parent):
@@ -193,6 +377,15 @@ def render_item(itemkey, item, parent):
         if (itemkey == 'filename'):
             linkURL = url_for('mongomanager.showfile', id=str(parent.id))
             link = "<a href='"+linkURL+"'>"+str(item)+"</a>"
+            # Show a thumbnail of image files
+            if (thumbnails.available() and 
+                    isinstance(getattr(parent, 'filetype', None), str) and
+                    file_extension(parent) in IMAGE_TYPES):
+                thumbURL = url_for('mongomanager.getthumbnail', 
+                                   id=str(parent.id), 
+                                   size=min(thumbnail_sizes()))
+                link = ("<a href='"+linkURL+"'><img src='"+thumbURL+
+                        "'></img></a> " + link)
             return link
         elif (itemkey == 'filepath'):
             linkURL = url_for('mongomanager.render_directory',
@@ -215,6 +408,19 @@ def render_item(itemkey, item, parent):
                 linkText = "&lt;"+item.__class__.__name__+"&gt;"
             link = "<a href='"+linkURL+"'>"+linkText+"</a>"
             return link
+        # If the item is an unresolved reference, link to the reference 
+        # page using the prefetched link text
+        elif item.__class__ is bson.DBRef:
+            className, linkText = lookup_reference(item)
+            if className is None:
+                return str(item.id)
+            if linkText is None:
+                linkText = "&lt;"+className+"&gt;"
+            linkURL = url_for('mongomanager.object', 
+                              className=className, 
+                              id=str(item.id))
+            link = "<a href='"+linkURL+"'>"+str(linkText)+"</a>"
+            return link
         # If the item is an ObjectId, link to its reference page
         elif item.__class__ is bson.objectid.ObjectId:
             linkURL = url_for('mongomanager.object', 
@@ -234,7 +440,7 @@ def render_item(itemkey, item, parent):
             return text
         # If the item is a datetime, display in correct timezone
         elif item.__class__ is datetime:
-            return pytz.utc.localize(item).astimezone().strftime("%m/%d/%Y %H:%M:%S")
+            return format_datetime(item)
         # Otherwise, try to dump to a string
         else:
             return str(item)
@@ -244,76 +450,682 @@ def render_item(itemkey, item, parent):
 # Add the route to the global namespace 
 mongomanager.add_app_template_global(render_item)
 
+# Rendered table rows and object pages, keyed by the document's class, id
+# and modifieddate (which TrackedAssignment.update and save stamp), so a 
+# document is only rendered again once it changes. Link text from other 
+# documents can be stale for up to MONGOMANAGER_FRAGMENT_CACHE_TTL 
+# seconds. MONGOMANAGER_FRAGMENT_CACHE adds a cache shared between 
+# processes: a redis:// URL or a directory.
+FRAGMENT_CACHE_SIZE = 10000
+FRAGMENT_CACHE_TTL = 3600
+fragmentCache = TieredCache(TTLCache(maxsize=FRAGMENT_CACHE_SIZE, 
+                                     ttl=FRAGMENT_CACHE_TTL))
+
+def configure_fragments(state):
+    config = state.app.config
+    ttl = config.get('MONGOMANAGER_FRAGMENT_CACHE_TTL', FRAGMENT_CACHE_TTL)
+    size = config.get('MONGOMANAGER_FRAGMENT_CACHE_SIZE', 
+                      FRAGMENT_CACHE_SIZE)
+    fragmentCache.local = TTLCache(maxsize=size, ttl=ttl)
+    shared = config.get('MONGOMANAGER_FRAGMENT_CACHE')
+    if not shared:
+        fragmentCache.shared = None
+    elif shared.startswith(('redis://', 'rediss://', 'unix://')):
+        fragmentCache.shared = RedisCache(shared, ttl=ttl)
+    else:
+        fragmentCache.shared = DiskCache(shared, ttl=ttl, maxsize=size)
+mongomanager.record_once(configure_fragments)
+
+def fragment_key(item, kind):
+    modified = item._data.get('modifieddate')
+    if item.pk is None or modified is None:
+        return None
+    return (item.__class__.__name__, str(item.pk), modified.isoformat(),
+            kind, request.script_root)
+
+# Cached fragments for items, as a list with None for those that still
+# need rendering.
+def cached_fragments(items, kind):
+    return [fragmentCache.get(key) if key is not None else None
+            for key in (fragment_key(item, kind) for item in items)]
+
+# A table row with the given columns of a document
+def render_row(item, columns, fragment=None):
+    if fragment is None:
+        fragment = ''.join("<td class='bigtable'>" + 
+                           str(render_item(key, item[key], item)) + "</td>"
+                           for key in columns)
+        key = fragment_key(item, ('row',) + tuple(columns))
+        if key is not None:
+            fragmentCache.set(key, fragment)
+    return fragment
+
+# The list of fields on an object's page
+def render_fields(item, fragment=None):
+    if fragment is None:
+        fragment = ''.join('<li><b> ' + str(escape(key)) + ':</b> ' + 
+                           str(render_item(key, item[key], item)) + 
+                           ' </li>\n' for key in item._fields.keys())
+        key = fragment_key(item, 'fields')
+        if key is not None:
+            fragmentCache.set(key, fragment)
+    return fragment
+
+# File metadata doesn't change once the file is written, so lookups by
+# id are cached across requests.
+fileCache = TTLCache(maxsize=4096, ttl=300)
+
+# Stored content is addressed by its hash and never changes, so it can 
+# be cached by the browser for as long as it likes.
+FILE_MAX_AGE = 31536000
+
+def get_file(id):
+    fileObj = fileCache.get(id)
+    if fileObj is None:
+        if not bson.ObjectId.is_valid(id):
+            abort(404)
+        fileObj = db.File.objects(id=id).first()
+        if fileObj is None:
+            fileObj = archive.history_objects(db.File)(id=id).first()
+        if fileObj is None:
+            abort(404)
+        fileCache.set(id, fileObj)
+    return fileObj
+
+# Size (in characters) and nesting depth of JSON previews, overridable 
+# with MONGOMANAGER_PREVIEW_SIZE and MONGOMANAGER_PREVIEW_DEPTH. The user
+# can ask for more ("Show more" and "Show deeper"), up to 
+# MAX_PREVIEW_SIZE and MAX_PREVIEW_DEPTH.
+PREVIEW_SIZE = 256*1024
+PREVIEW_DEPTH = 8
+MAX_PREVIEW_SIZE = 64*1024*1024
+MAX_PREVIEW_DEPTH = 64
+PREVIEW_SIZE_FACTOR = 4
+PREVIEW_DEPTH_STEP = 4
+
+# Requested limits are rounded up to the default times a power of 
+# PREVIEW_SIZE_FACTOR, and depths to the default plus a multiple of 
+# PREVIEW_DEPTH_STEP, so that only a few previews per file are ever
+# cached.
+def preview_limit(requested, default):
+    limit = max(1, min(default, MAX_PREVIEW_SIZE))
+    while limit < min(requested, MAX_PREVIEW_SIZE):
+        limit *= PREVIEW_SIZE_FACTOR
+    return min(limit, MAX_PREVIEW_SIZE)
+
+def preview_depth(requested, default):
+    depth = max(1, min(default, MAX_PREVIEW_DEPTH))
+    while depth < min(requested, MAX_PREVIEW_DEPTH):
+        depth += PREVIEW_DEPTH_STEP
+    return min(depth, MAX_PREVIEW_DEPTH)
+
+def preview_name(fileObj, limit, depth):
+    return os.path.join(fileObj.getpath(), '%s.preview-%d-%d.txt' % 
+                        (fileObj.getfilename(), limit, depth))
+
+# A cached preview's first line holds its truncated and collapsed flags
+PREVIEW_FLAGS = re.compile(r'^([01]) ([01])\n$')
+
+# A cached preview as (text, truncated, collapsed), or None if there is
+# none (or it was cached without the flags line)
+def read_preview(previewname):
+    try:
+        with open(previewname, 'r', encoding='utf-8') as f:
+            match = PREVIEW_FLAGS.match(f.readline())
+            if match is None:
+                return None
+            return f.read(), match.group(1) == '1', match.group(2) == '1'
+    except FileNotFoundError:
+        return None
+
+# Returns a bounded, pretty printed preview of a JSON file as (text, 
+# truncated, collapsed). Previews are cached on disk next to the file,
+# keyed by its hash and the limits, since the content never changes.
+def json_preview(fileObj, limit, depth):
+    previewname = preview_name(fileObj, limit, depth)
+    cached = read_preview(previewname)
+    if cached is not None:
+        return cached
+    os.makedirs(fileObj.getpath(), exist_ok=True)
+    fd, tempname = tempfile.mkstemp(dir=fileObj.getpath())
+    os.fchmod(fd, db.FILEMODE)
+    try:
+        with io.TextIOWrapper(fileObj.open(), encoding='utf-8',
+                              errors='replace') as infile, \
+             os.fdopen(fd, 'w', encoding='utf-8') as outfile:
+            outfile.write('0 0\n')
+            truncated, collapsed = preview.json_preview(infile, outfile, 
+                                                        limit, depth)
+            # Fill in the flags, now that they're known
+            outfile.seek(0)
+            outfile.write('%d %d\n' % (truncated, collapsed))
+        os.replace(tempname, previewname)
+    finally:
+        if os.path.exists(tempname):
+            os.remove(tempname)
+    return read_preview(previewname)
+
+# The file's extension, from a filetype given either as a filename or 
+# as a bare extension
+def file_extension(fileObj):
+    stem, ext = os.path.splitext(fileObj.filetype or '')
+    if ext == '' and stem != '':
+        ext = '.' + stem
+    return ext.lower()
+
+# Image files get downscaled derivatives for pages and thumbnails. The
+# allowed sizes (the largest is the preview on showfile pages) are set
+# with MONGOMANAGER_THUMBNAIL_SIZES, and MONGOMANAGER_THUMBNAIL_WORKERS
+# threads generate them in the background.
+IMAGE_TYPES = ('.png', '.jpg', '.jpeg', '.gif', '.tif', '.tiff', '.bmp')
+THUMBNAIL_SIZES = (128, 1024)
+
+def thumbnail_sizes():
+    return current_app.config.get('MONGOMANAGER_THUMBNAIL_SIZES', 
+                                  THUMBNAIL_SIZES)
+
 # Displays a page showing a file resource
 @mongomanager.route('/showfile/<id>')
 @requires_perm('admin')
 def showfile(id):
-    fileObj = db.File.objects(id=id).first()
-    stem, ext = os.path.splitext(fileObj.filetype)
+    fileObj = get_file(id)
+    ext = file_extension(fileObj)
     if ext == '.json':
-        with open(os.path.join(fileObj.getpath(),
-                               fileObj.getfilename()),'r') as f:
-            jsonData = json.load(f)
-        prettyData = json.dumps(jsonData, indent = 4, sort_keys=True)
+        defaultLimit = current_app.config.get('MONGOMANAGER_PREVIEW_SIZE', 
+                                              PREVIEW_SIZE)
+        limit = preview_limit(request.args.get('limit', defaultLimit, 
+                                               type=int), defaultLimit)
+        defaultDepth = current_app.config.get('MONGOMANAGER_PREVIEW_DEPTH', 
+                                              PREVIEW_DEPTH)
+        depth = preview_depth(request.args.get('depth', defaultDepth, 
+                                               type=int), defaultDepth)
+        prettyData, truncated, collapsed = json_preview(fileObj, limit, 
+                                                        depth)
         return render_template('showjson.html', 
-                               fileObj=fileObj, jsonData=prettyData)
-    elif ext == '.png':
-        return render_template('showpng.html', fileObj=fileObj)
+                               fileObj=fileObj, jsonData=prettyData,
+                               limit=limit, depth=depth,
+                               truncated=truncated and 
+                                         limit < MAX_PREVIEW_SIZE,
+                               collapsed=collapsed and 
+                                         depth < MAX_PREVIEW_DEPTH,
+                               moreLimit=limit*PREVIEW_SIZE_FACTOR,
+                               deeperDepth=depth + PREVIEW_DEPTH_STEP)
+    elif ext in IMAGE_TYPES:
+        size = max(thumbnail_sizes())
+        if thumbnails.available():
+            thumbnails.schedule(fileObj, size, current_app.config.get(
+                                'MONGOMANAGER_THUMBNAIL_WORKERS', 0))
+        return render_template('showpng.html', fileObj=fileObj, 
+                               previewsize=size)
     else:
         # return 'implementation in progress'
         return getfile(id=id)
 
-
+# Returns the file, with a strong ETag and long lived cache headers 
+# derived from its hash. Conditional requests are answered without 
+# touching the disk, and Range requests are served as partial content.
+# If MONGOMANAGER_ACCEL_REDIRECT is set to the internal nginx location
+# that maps onto File.basepath (or to a dict of basepath: location), 
+# nginx sends the bytes instead of the worker. Flask's USE_X_SENDFILE 
+# setting is honoured as usual. Files stored compressed are sent as they
+# are, with Content-Encoding, to clients that accept the encoding, and 
+# decompressed on the fly for others.
 @mongomanager.route('/getfile/<id>')
 @requires_perm('admin')
 def getfile(id):
-    fileObj = db.File.objects(id=id).first()
+    fileObj = get_file(id)
     download_name=fileObj.getfilename() + '.' + fileObj.filetype
-    return send_from_directory(fileObj.getpath(), 
-                             fileObj.getfilename(), 
-                             as_attachment=True, 
-                             attachment_filename=download_name)
+    mimetype = (mimetypes.guess_type(download_name)[0] or 
+                'application/octet-stream')
+    accel = current_app.config.get('MONGOMANAGER_ACCEL_REDIRECT')
+    if isinstance(accel, dict):
+        accel = accel.get(fileObj.basepath)
+    encoded = (fileObj.encoding != '' and 
+               request.accept_encodings[fileObj.encoding] > 0)
+    # Each representation gets its own ETag
+    etag = fileObj.hashstring
+    if encoded:
+        etag += '-' + fileObj.encoding
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    elif encoded:
+        response = send_from_directory(fileObj.getpath(),
+                                 os.path.basename(fileObj.getstoredname()),
+                                 mimetype=mimetype,
+                                 as_attachment=True, 
+                                 attachment_filename=download_name,
+                                 conditional=True,
+                                 add_etags=False)
+        response.headers['Content-Encoding'] = fileObj.encoding
+    elif fileObj.encoding != '':
+        response = Response(wrap_file(request.environ, fileObj.open()),
+                            mimetype=mimetype, direct_passthrough=True)
+        response.headers['Content-Disposition'] = (
+                'attachment; filename="' + download_name + '"')
+    elif fileObj.storage == 'segment':
+        # Packed objects are served straight from the segment's mmap
+        data = fileObj.open()
+        length = data.seek(0, io.SEEK_END)
+        data.seek(0)
+        response = Response(wrap_file(request.environ, data), 
+                            mimetype=mimetype, direct_passthrough=True)
+        response.content_length = length
+        response.headers['Content-Disposition'] = (
+                'attachment; filename="' + download_name + '"')
+        response.make_conditional(request, accept_ranges=True,
+                                  complete_length=length)
+    elif accel:
+        relpath = os.path.relpath(os.path.join(fileObj.getpath(),
+                                               fileObj.getfilename()),
+                                  fileObj.basepath)
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = (accel.rstrip('/') + '/' + 
+                                                relpath)
+        response.headers['Content-Disposition'] = (
+                'attachment; filename="' + download_name + '"')
+    else:
+        response = send_from_directory(fileObj.getpath(), 
+                                 fileObj.getfilename(), 
+                                 as_attachment=True, 
+                                 attachment_filename=download_name,
+                                 conditional=True,
+                                 add_etags=False)
+    response.set_etag(etag)
+    if fileObj.encoding != '':
+        response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = ('private, max-age=%d, immutable' 
+                                         % FILE_MAX_AGE)
+    return response
+
+
+# Caches whose hit rates are shown with the metrics
+def named_caches():
+    return dict(roles=roleCache, files=fileCache, directories=dirCache,
+                fragments=fragmentCache)
+
+# Admin page with per-route latency and query count statistics
+@mongomanager.route('/metrics')
+@requires_perm('admin')
+def metrics_page():
+    routeList = []
+    for endpoint, route in metrics.routeMetrics.snapshot():
+        routeList.append(dict(endpoint=endpoint,
+                              count=route['latency'].count,
+                              mean=route['latency'].mean()*1000,
+                              p50=route['latency'].quantile(0.5)*1000,
+                              p95=route['latency'].quantile(0.95)*1000,
+                              queries=route['queries'].mean(),
+                              querytime=route['querytime'].mean()*1000))
+    cacheList = [(name, cache.hits, cache.misses, len(cache)) 
+                 for name, cache in sorted(named_caches().items())]
+    return render_template('metrics.html', routeList=routeList,
+                           cacheList=cacheList)
+
+# The same metrics in Prometheus text format. Scrapers can authenticate 
+# with an "Authorization: Bearer <MONGOMANAGER_METRICS_TOKEN>" header 
+# instead of logging in.
+@mongomanager.route('/metrics/prometheus')
+def prometheus():
+    def text():
+        return Response(metrics.prometheus_text(named_caches()),
+                        mimetype='text/plain; version=0.0.4')
+    token = current_app.config.get('MONGOMANAGER_METRICS_TOKEN')
+    if token and hmac.compare_digest(
+            request.headers.get('Authorization', ''), 'Bearer ' + token):
+        return text()
+    return requires_perm('admin')(text)()
+
+# The concrete Document classes of the application's database module by
+# name, built once when the blueprint is registered.
+models = OrderedDict()
+
+def build_registry(state):
+    models.clear()
+    for name, item in sorted(db.__dict__.items()):
+        if hasattr(item, '_collection') and not item._meta.get('abstract'):
+            models[item.__name__] = item
+mongomanager.record_once(build_registry)
+
+# Files of up to MONGOMANAGER_SEGMENT_THRESHOLD bytes are packed into 
+# segment files instead of the hashstring directories (see segments.py).
+# Files with the filetypes in MONGOMANAGER_COMPRESS_TYPES are stored
+# compressed with MONGOMANAGER_COMPRESSION (see compression.py).
+def configure_storage(state):
+    threshold = state.app.config.get('MONGOMANAGER_SEGMENT_THRESHOLD')
+    if threshold is not None:
+        db.File.segmentthreshold = threshold
+    compresstypes = state.app.config.get('MONGOMANAGER_COMPRESS_TYPES')
+    if compresstypes is not None:
+        db.File.compresstypes = tuple('.' + filetype.lstrip('.').lower()
+                                      for filetype in compresstypes)
+    encoding = state.app.config.get('MONGOMANAGER_COMPRESSION')
+    if encoding is not None:
+        db.File.compressencoding = encoding
+mongomanager.record_once(configure_storage)
+
+def document_classes():
+    if len(models) == 0:
+        build_registry(None)
+    return list(models.values())
+
+def get_model(className):
+    if len(models) == 0:
+        build_registry(None)
+    if className not in models:
+        abort(404)
+    return models[className]
+
+# Representative queries issued by the blueprint for a class, with 
+# placeholder values, for the index page's explain() plans.
+def blueprint_queries(classObj):
+    keys = sort_keys(classObj)
+    queries = [('collection page', classObj.objects()
+                    .order_by(*sort_order(keys)).limit(PAGE_SIZE))]
+    if 'name' in classObj._fields.keys():
+        queries.append(('lookup', classObj.objects(iscurrent=True, 
+                            name__startswith='a').order_by('+name')
+                            .only('id', 'name').limit(LOOKUP_SIZE)))
+    if issubclass(classObj, db.RoleAssignment):
+        queries.append(('current roles', classObj.objects(
+                            user=bson.ObjectId(), iscurrent=True)
+                            .only('role')))
+    if issubclass(classObj, db.User):
+        queries.append(('login', classObj.objects(username='a', 
+                                                  iscurrent=True)))
+    if issubclass(classObj, db.File):
+        queries.append(('directory page', classObj.objects(filepath='/a', 
+                            filename__in=['a']).only('id', 'filename')))
+    return queries
+
+# Representative aggregations issued by the blueprint for a class, as 
+# (label, pipeline) pairs
+def blueprint_pipelines(classObj):
+    pipelines = []
+    if issubclass(classObj, db.User):
+        pipelines.append(('role matrix', role_matrix_pipeline()))
+    return pipelines
 
+# Summarize an explain() plan as a chain of stages, e.g. 
+# LIMIT <- FETCH <- IXSCAN(name)
+def plan_summary(plan):
+    text = plan.get('stage', '?')
+    if 'indexName' in plan:
+        text += '(' + plan['indexName'] + ')'
+    if 'strategy' in plan:
+        text += '[' + plan['strategy'] + ']'
+    if 'inputStage' in plan:
+        inputs = [plan['inputStage']]
+    else:
+        inputs = plan.get('inputStages', [])
+    if len(inputs) > 0:
+        text += ' <- ' + ', '.join(plan_summary(item) for item in inputs)
+    return text
+
+def winning_plan(queryPlanner):
+    plan = queryPlanner['winningPlan']
+    return plan.get('queryPlan', plan)
+
+# Summarize an aggregate explain: the plan of the query it starts with 
+# and, for each $lookup, the indexes used for the join (COLLSCAN for 
+# none). Newer servers push the $lookup into the query plan instead, as
+# an EQ_LOOKUP stage.
+def pipeline_summary(explain):
+    if 'queryPlanner' in explain:
+        return plan_summary(winning_plan(explain['queryPlanner']))
+    parts = []
+    for stage in explain.get('stages', []):
+        if '$cursor' in stage:
+            parts.append(plan_summary(winning_plan(
+                    stage['$cursor']['queryPlanner'])))
+        elif '$lookup' in stage:
+            parts.append('$lookup(' + (', '.join(stage.get('indexesUsed', 
+                                                           []))
+                                       or 'COLLSCAN') + ')')
+    return ' -> '.join(parts)
+
+# Admin route listing each collection's indexes, their sizes and usage,
+# and the plans for the queries the blueprint issues against it.
+@mongomanager.route('/indexes')
+@requires_perm('admin')
+def indexes():
+    collectionList = []
+    seen = set()
+    for classObj in document_classes():
+        collection = classObj._get_collection()
+        if collection.name in seen:
+            continue
+        seen.add(collection.name)
+        try:
+            sizes = collection.database.command('collStats', 
+                        collection.name).get('indexSizes', dict())
+        except:
+            sizes = dict()
+        try:
+            usage = dict((item['name'], item['accesses']) for item 
+                         in collection.aggregate([{'$indexStats': {}}]))
+        except:
+            usage = dict()
+        indexList = []
+        for name, info in sorted(collection.index_information().items()):
+            accesses = usage.get(name, dict())
+            indexList.append(dict(name=name, key=info['key'],
+                                  unique=info.get('unique', False),
+                                  size=sizes.get(name),
+                                  ops=accesses.get('ops'),
+                                  since=accesses.get('since')))
+        planList = []
+        for label, query in blueprint_queries(classObj):
+            try:
+                plan = winning_plan(query.explain()['queryPlanner'])
+                planList.append((label, plan_summary(plan)))
+            except Exception as e:
+                planList.append((label, 'unavailable: ' + str(e)))
+        for label, pipeline in blueprint_pipelines(classObj):
+            try:
+                explain = collection.database.command(
+                        {'explain': {'aggregate': collection.name,
+                                     'pipeline': pipeline, 'cursor': {}},
+                         'verbosity': 'executionStats'})
+                planList.append((label, pipeline_summary(explain)))
+            except Exception as e:
+                planList.append((label, 'unavailable: ' + str(e)))
+        collectionList.append(dict(name=collection.name, 
+                                   className=classObj.__name__,
+                                   indexList=indexList,
+                                   planList=planList))
+    return render_template('indexes.html', collectionList=collectionList)
+
+# Statistics for each collection by class name, as (time, stats). They
+# are refreshed in the background once older than MONGOMANAGER_STATS_TTL
+# seconds, so the collections page never waits on them.
+STATS_TTL = 300
+collectionStats = dict()
+statsRefreshing = threading.Lock()
+
+def compute_stats(classObj):
+    collection = classObj._get_collection()
+    stats = dict(documents=collection.estimated_document_count(),
+                 current=classObj.objects(iscurrent=True).count(),
+                 retired=classObj.objects(iscurrent=False).count(),
+                 archived=archive.history_collection(classObj)
+                                 .estimated_document_count())
+    try:
+        collStats = collection.database.command('collStats', 
+                                                collection.name)
+        stats['size'] = collStats.get('size')
+        stats['storagesize'] = collStats.get('storageSize')
+        stats['indexsize'] = collStats.get('totalIndexSize')
+    except:
+        pass
+    latest = (classObj.objects().order_by('-modifieddate')
+              .only('modifieddate').first())
+    if latest is not None:
+        stats['modified'] = latest.modifieddate
+    return stats
+
+def refresh_stats(classes):
+    try:
+        for classObj in classes:
+            try:
+                collectionStats[classObj.__name__] = (time.monotonic(),
+                                                      compute_stats(classObj))
+            except:
+                db.logger.exception('Unable to get statistics for ' + 
+                                    classObj.__name__)
+    finally:
+        statsRefreshing.release()
+
+def get_stats(classes):
+    ttl = current_app.config.get('MONGOMANAGER_STATS_TTL', STATS_TTL)
+    now = time.monotonic()
+    stale = [classObj for classObj in classes 
+             if classObj.__name__ not in collectionStats or
+             now - collectionStats[classObj.__name__][0] > ttl]
+    if len(stale) > 0 and statsRefreshing.acquire(blocking=False):
+        threading.Thread(target=refresh_stats, args=(stale,), 
+                         daemon=True).start()
+    return dict((name, stats) for name, (when, stats) 
+                in collectionStats.items())
+
+# Returns a downscaled PNG of an image file, generated on first request
+# and then served from disk with immutable cache headers. Falls back to
+# the original when Pillow isn't installed or can't read the image.
+@mongomanager.route('/getfile/<id>/thumb/<int:size>')
+@requires_perm('admin')
+def getthumbnail(id, size):
+    fileObj = get_file(id)
+    if size not in thumbnail_sizes():
+        return abort(404)
+    if not thumbnails.available() or file_extension(fileObj) not in IMAGE_TYPES:
+        return redirect(url_for('.getfile', id=id))
+    etag = '%s-%d' % (fileObj.hashstring, size)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        filename = thumbnails.thumbnail(fileObj, size, 
+                        current_app.config.get(
+                            'MONGOMANAGER_THUMBNAIL_WORKERS', 0))
+        if filename is None:
+            return redirect(url_for('.getfile', id=id))
+        response = send_from_directory(os.path.dirname(filename), 
+                                       os.path.basename(filename),
+                                       mimetype='image/png',
+                                       conditional=True,
+                                       add_etags=False)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = ('private, max-age=%d, immutable' 
+                                         % FILE_MAX_AGE)
+    return response
 
 # Utility route to list all the database collections
 @mongomanager.route('/collections')
 @requires_perm('admin')
 def collections():
-    classList = []
-    for item in db.__dict__.keys():
-        if hasattr(getattr(db,item),'_collection'):
-            classList.append(getattr(db,item).__name__)
-    return render_template('collections.html', classList=classList)   
+    classList = [classObj.__name__ for classObj in document_classes()]
+    return render_template('collections.html', classList=classList,
+                           stats=get_stats(document_classes()))
 
 # Utility route to inspect an object
 @mongomanager.route('/collection/<className>/<id>')
 @requires_perm('admin')
 def object(className, id):
     try:
-        classObj = getattr(db, className)
-        anObject = classObj.objects(id=id).first()
-        return render_template('object.html', anObject=anObject)
+        classObj = get_model(className)
+        anObject = classObj.objects(id=id).no_dereference().first()
+        if anObject is None:
+            anObject = (archive.history_objects(classObj)(id=id)
+                        .no_dereference().first())
+        fragment = cached_fragments([anObject], 'fields')[0]
+        if fragment is None:
+            prefetch_references([anObject])
+        return render_template('object.html', anObject=anObject,
+                               fields=render_fields(anObject, fragment))
     except:
         return abort(404)
 
+# Page sizes for the collection view, overridable with the
+# MONGOMANAGER_PAGE_SIZE and MONGOMANAGER_MAX_PAGE_SIZE settings.
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+LOOKUP_SIZE = 20
+
+# Sort keys for a collection page, most significant first. The trailing
+# _id makes the order total so that a page can seek past its last row.
+def sort_keys(classObj):
+    if 'name' in classObj._fields.keys():
+        return [('iscurrent', -1), ('name', 1), ('id', 1)]
+    else:
+        return [('iscurrent', -1), ('addeddate', 1), ('id', 1)]
+
+# The sort keys as arguments for QuerySet.order_by()
+def sort_order(keys):
+    return [('-' if direction < 0 else '+') + key 
+            for key, direction in keys]
+
+# Encode the sort key values of the last row on a page as an opaque
+# cursor for the next page, and decode it again.
+def encode_cursor(item, keys):
+    values = [item[key] for key, direction in keys]
+    text = bson.json_util.dumps(values)
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    text = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    return bson.json_util.loads(text)
+
+# Build a raw query selecting the rows that sort after the given key
+# values, i.e. (k1 > v1) or (k1 == v1 and k2 > v2) or ... Missing and
+# null values sort before everything else, so nothing comes after a
+# null in descending order, and nulls come after any other value.
+def keyset_query(classObj, keys, values):
+    clauses = []
+    for i, (key, direction) in enumerate(keys):
+        field = classObj._fields[key].db_field
+        clause = dict()
+        for (prevkey, prevdir), prevvalue in zip(keys[:i], values[:i]):
+            clause[classObj._fields[prevkey].db_field] = prevvalue
+        if values[i] is None:
+            if direction < 0:
+                continue
+            clause[field] = {'$ne': None}
+        elif direction > 0:
+            clause[field] = {'$gt': values[i]}
+        else:
+            clause['$or'] = [{field: {'$lt': values[i]}}, {field: None}]
+        clauses.append(clause)
+    return {'$or': clauses}
+
+# Compare two rows in sort key order, for merging pages, with missing
+# values first as Mongo sorts them
+def compare_rows(item1, item2, keys):
+    for key, direction in keys:
+        value1, value2 = item1[key], item2[key]
+        if value1 != value2:
+            if value1 is None or value2 is None:
+                greater = value2 is None
+            else:
+                greater = value1 > value2
+            return direction if greater else -direction
+    return 0
+
+# Searches from the query bar give up after this long (milliseconds),
+# overridable with MONGOMANAGER_SEARCH_TIMEOUT_MS
+SEARCH_TIMEOUT_MS = 5000
+
+# Which rows the collection view shows: only current ones (the default),
+# all those in the live collection plus the archived ones, or only the 
+# archived ones (see archive.py).
+SCOPES = ('current', 'all', 'history')
+
 # Utility route to inspect and edit a single collection
 mongomanager.app_template_global(getattr)
 @mongomanager.route('/collection/<className>', methods=['GET','POST'])
 @requires_perm('admin')
 def collection(className):
-    classObj = getattr(db, className)
+    classObj = get_model(className)
     form = forms.ItemForm()
-    if 'name' in classObj._fields.keys():
-        itemList = classObj.objects().order_by('-iscurrent', '+name')
-        form.remitem.choices = [(str(item.id),item.name) for item 
-                                     in itemList if item.iscurrent]
-    else:
-        itemList = classObj.objects().order_by('-iscurrent', '+addeddate')
-        form.remitem.choices = [(str(item.id),str(item.id)) for item 
-                                     in itemList if item.iscurrent]
-    form.remitem.choices.insert(0,(' ',' '))
     if request.method == 'POST' and form.validate():
-        current_user = db.User.objects(id=session['userid']).first()
+        current_user = get_current_user()
         if len(form.additem.data) > 0:
             try:
                 newItem = classObj(name=form.additem.data,
@@ -322,13 +1134,18 @@ def collection(className):
                                 iscurrent = True)
                 newItem.save()
                 flash('Added item: ' + newItem.name)
-                return redirect(url_for('collection', className=className))
+                return redirect(url_for('.collection', className=className))
             except:
                 form.additem.errors.append('Unable to add item.')
-        if form.remitem.data != ' ':
+        if len(form.remitem.data) > 0:
             try:
-                item = classObj.objects(iscurrent=True, 
-                                        id=form.remitem.data).first()
+                # The picker submits an id, but accept a typed name too
+                if bson.ObjectId.is_valid(form.remitem.data):
+                    item = classObj.objects(iscurrent=True, 
+                                            id=form.remitem.data).first()
+                else:
+                    item = classObj.objects(iscurrent=True, 
+                                            name=form.remitem.data).first()
                 item.update(iscurrent=False,
                         removedby=current_user,
                         removeddate=datetime.utcnow())
@@ -337,25 +1154,254 @@ def collection(className):
                     flash('Removed item: ' + item.name)
                 else:
                     flash('Removed item: ' + str(item.id))
-                return redirect(url_for('collection', className=className))
+                return redirect(url_for('.collection', className=className))
             except:
                 form.remitem.errors.append('Item not found.')
+
+    # Fetch one page of rows, seeking past the cursor on the sort keys
+    # and projecting only the displayed columns.
+    pagesize = request.args.get('pagesize', 
+                    current_app.config.get('MONGOMANAGER_PAGE_SIZE', 
+                                           PAGE_SIZE), type=int)
+    pagesize = max(1, min(pagesize, current_app.config.get(
+                    'MONGOMANAGER_MAX_PAGE_SIZE', MAX_PAGE_SIZE)))
+    columns = [key for key in request.args.get('fields', '').split(',')
+               if key in classObj._fields.keys()]
+    if len(columns) == 0:
+        columns = list(classObj._fields.keys())
+    scope = request.args.get('scope', 'current')
+    if scope not in SCOPES:
+        return abort(400)
+    keys = sort_keys(classObj)
+    raw = []
+    cursor = request.args.get('after')
+    if cursor:
+        try:
+            raw.append(keyset_query(classObj, keys, decode_cursor(cursor)))
+        except:
+            return abort(400)
+    # Filter on the query bar's terms (see search.py), with a time limit
+    q = request.args.get('q', '')
+    searchError = None
+    try:
+        searchFilter = search.parse_search(classObj, q)
+    except search.SearchError as e:
+        searchFilter = None
+        searchError = str(e)
+    if searchFilter is not None:
+        raw.append(searchFilter)
+    timeout = current_app.config.get('MONGOMANAGER_SEARCH_TIMEOUT_MS', 
+                                     SEARCH_TIMEOUT_MS)
+    querysets = []
+    if scope == 'current':
+        querysets.append(classObj.objects(iscurrent=True))
+    elif scope == 'all':
+        querysets.append(classObj.objects())
+    if scope in ('all', 'history'):
+        querysets.append(archive.history_objects(classObj))
+    # With history included, the next page is merged from a page of each
+    projection = set(columns) | set(key for key, direction in keys)
+    if 'modifieddate' in classObj._fields.keys():
+        projection.add('modifieddate') # For the fragment cache key
+    itemList = []
+    for query in querysets:
+        if searchError is not None:
+            break
+        if len(raw) > 0:
+            query = query(__raw__=raw[0] if len(raw) == 1 else 
+                                  {'$and': raw})
+        query = query.order_by(*sort_order(keys))
+        if searchFilter is not None:
+            query = query.max_time_ms(timeout)
+        try:
+            itemList.extend(query.only(*projection).no_dereference()
+                                 .limit(pagesize + 1))
+        except OperationFailure as e:
+            # Timed out, or a $text search without a text index
+            itemList = []
+            searchError = 'The search failed: ' + str(e)
+    if len(querysets) > 1:
+        itemList.sort(key=cmp_to_key(
+                lambda item1, item2: compare_rows(item1, item2, keys)))
+    nextURL = None
+    if len(itemList) > pagesize:
+        itemList = itemList[:pagesize]
+        nextURL = url_for('.collection', className=className,
+                          after=encode_cursor(itemList[-1], keys),
+                          pagesize=pagesize, scope=scope, q=q or None,
+                          fields=request.args.get('fields'))
+    # Only rows missing from the fragment cache need their references
+    kind = ('row',) + tuple(columns)
+    fragments = cached_fragments(itemList, kind)
+    prefetch_references([item for item, fragment 
+                         in zip(itemList, fragments) if fragment is None])
+    rows = [render_row(item, columns, fragment) for item, fragment
+            in zip(itemList, fragments)]
     return render_template('collection.html',
-                           form=form, itemList=itemList, 
+                           form=form, rows=rows, columns=columns,
+                           nextURL=nextURL, firstPage=(cursor is None),
+                           scope=scope, scopes=SCOPES, q=q,
+                           searchError=searchError,
                            classObj=classObj, className=className)
 
+# Convert a raw field value for export the way render_item displays it,
+# without dereferencing: ids and references as their id, datetimes in 
+# the server's timezone.
+def export_value(value):
+    if isinstance(value, bson.ObjectId):
+        return str(value)
+    elif isinstance(value, bson.DBRef):
+        return str(value.id)
+    elif isinstance(value, datetime):
+        return format_datetime(value)
+    elif isinstance(value, list):
+        return [export_value(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((key, export_value(item)) for key, item 
+                    in value.items())
+    else:
+        return value
+
+# Rows exported per batch read from the server, overridable with the
+# batch_size query arg.
+EXPORT_BATCH_SIZE = 1000
+
+# Exported rows are sent as soon as the first one is read, and then in
+# chunks of about EXPORT_CHUNK_SIZE characters, at least every
+# EXPORT_FLUSH_INTERVAL seconds, and before each new batch is fetched.
+EXPORT_CHUNK_SIZE = 65536
+EXPORT_FLUSH_INTERVAL = 1.0
+
+# Format raw documents as CSV or NDJSON text chunks
+def export_rows(docs, fmt, columns, dbfields, batchsize):
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    count = 0
+    flushed = time.monotonic()
+    for doc in docs:
+        values = [export_value(doc.get(dbkey)) for key, dbkey in dbfields]
+        if fmt == 'csv':
+            writer.writerow([json.dumps(value) if isinstance(value, 
+                             (list, dict)) else value for value in values])
+        else:
+            buffer.write(json.dumps(dict(zip(columns, values))))
+            buffer.write('\n')
+        count += 1
+        if (count == 1 or count % batchsize == 0 or 
+                buffer.tell() >= EXPORT_CHUNK_SIZE or
+                time.monotonic() - flushed >= EXPORT_FLUSH_INTERVAL):
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            flushed = time.monotonic()
+    if buffer.tell() > 0:
+        yield buffer.getvalue()
+
+# Gzip text chunks, flushing the compressor after each one so that every
+# chunk reaches the client as soon as it is ready
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # gzip format
+    for chunk in chunks:
+        yield (compressor.compress(chunk.encode('utf-8')) + 
+               compressor.flush(zlib.Z_SYNC_FLUSH))
+    yield compressor.flush()
+
+# Export a collection as NDJSON or CSV, streamed straight from a server 
+# side cursor a batch at a time so memory use doesn't depend on the size
+# of the collection. Query args: fields, iscurrent (true/false), 
+# scope (as for the collection view; without it the live collection is
+# exported), q (a query bar search), batch_size and gzip.
+@mongomanager.route('/collection/<className>/export/<fmt>')
+@requires_perm('admin')
+def export(className, fmt):
+    classObj = get_model(className)
+    if fmt not in ('ndjson', 'csv'):
+        return abort(404)
+    columns = [key for key in request.args.get('fields', '').split(',')
+               if key in classObj._fields.keys()]
+    if len(columns) == 0:
+        columns = list(classObj._fields.keys())
+    dbfields = [(key, classObj._fields[key].db_field) for key in columns]
+    filters = dict()
+    if request.args.get('iscurrent'):
+        filters['iscurrent'] = (request.args['iscurrent'].lower() in 
+                                ('1', 'true', 'yes'))
+    scope = request.args.get('scope')
+    if scope is not None and scope not in SCOPES:
+        return abort(400)
+    if scope == 'current':
+        filters['iscurrent'] = True
+    try:
+        searchFilter = search.parse_search(classObj, request.args.get('q'))
+    except search.SearchError as e:
+        return abort(400, str(e))
+    if searchFilter is not None:
+        filters['__raw__'] = searchFilter
+    collections = []
+    if scope != 'history':
+        collections.append(classObj._get_collection())
+    if scope in ('all', 'history'):
+        collections.append(archive.history_collection(classObj))
+    batchsize = max(1, min(request.args.get('batch_size', 
+                                            EXPORT_BATCH_SIZE, type=int),
+                           100000))
+    cursors = [collection.find(classObj.objects(**filters)._query,
+                               dict((dbkey, 1) for key, dbkey in dbfields),
+                               batch_size=batchsize).sort('_id', 1)
+               for collection in collections]
+    download_name = className + '.' + fmt
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    chunks = export_rows(itertools.chain(*cursors), fmt, columns, dbfields,
+                         batchsize)
+    if request.args.get('gzip'):
+        download_name += '.gz'
+        mimetype = 'application/gzip'
+        chunks = gzip_chunks(chunks)
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = (
+            'attachment; filename="' + download_name + '"')
+    return response
+
+# Incremental lookup of current items by name (or id prefix) that feeds
+# the remove-item picker on the collection page.
+@mongomanager.route('/collection/<className>/lookup')
+@requires_perm('admin')
+def lookup(className):
+    classObj = get_model(className)
+    term = request.args.get('q', '')
+    limit = min(request.args.get('limit', LOOKUP_SIZE, type=int), 
+                MAX_PAGE_SIZE)
+    query = classObj.objects(iscurrent=True)
+    if 'name' in classObj._fields.keys():
+        query = query(name__startswith=term).order_by('+name')
+        choices = [dict(id=str(item.id), text=item.name) for item
+                   in query.only('id', 'name').limit(limit)]
+    else:
+        # Match a hex prefix of the id as a range on _id
+        if re.match(r'^[0-9a-f]{1,24}$', term):
+            query = query(id__gte=term.ljust(24, '0'),
+                          id__lte=term.ljust(24, 'f'))
+        query = query.order_by('+id')
+        choices = [dict(id=str(item.id), text=str(item.id)) for item
+                   in query.only('id').limit(limit)]
+    return jsonify(choices)
+
 # Route for viewing and editing user roles.
 @mongomanager.route('/roles', methods=['GET','POST'])
 @requires_perm('admin')
 def roles():
     form = forms.RoleForm()
     if request.method == 'POST' and form.validate():
-        current_user = db.User.objects(id=session['userid']).first()
+        current_user = get_current_user()
         existing_user = db.User.objects(username=form.username.data).first()
         if existing_user is None:
             form.username.errors.append('User does not exist.')
         else:
-            existingRoles = existing_user.roleassignments
             addRole = form.addrole.data
             remRole = form.remrole.data
             if len(addRole) > 0:
@@ -365,9 +1411,7 @@ def roles():
                             addeddate = datetime.utcnow(),
                             iscurrent = True)
                 newRole.save()
-                existing_user.update(
-                        roleassignments=existingRoles.append(newRole))
-                existing_user.save()
+                existing_user.update(push__roleassignments=newRole)
                 flash('Added role: ' + addRole + 
                       ' for user: ' + existing_user.username)
             if len(remRole) > 0:
@@ -384,8 +1428,243 @@ def roles():
                     roleAssignment.save()
                     flash('Removed: ' + remRole + 
                           ' for: ' + existing_user.username)
-    roledata = [[user.username, [roleAssign.role for roleAssign 
-                 in user.roleassignments if roleAssign.iscurrent]] 
-                 for user in db.User.objects(iscurrent=True)]
-    return render_template('roles.html',form=form, roledata=roledata)
+            invalidate_roles(existing_user.id)
+    pagesize = max(1, min(request.args.get('pagesize', 
+                    current_app.config.get('MONGOMANAGER_PAGE_SIZE', 
+                                           PAGE_SIZE), type=int),
+                    current_app.config.get('MONGOMANAGER_MAX_PAGE_SIZE', 
+                                           MAX_PAGE_SIZE)))
+    after = request.args.get('after')
+    roledata = role_matrix(after, pagesize + 1)
+    nextURL = None
+    if len(roledata) > pagesize:
+        roledata = roledata[:pagesize]
+        nextURL = url_for('.roles', after=roledata[-1][0], 
+                          pagesize=pagesize)
+    return render_template('roles.html', form=form, roledata=roledata,
+                           bulkform=forms.BulkRoleForm(), nextURL=nextURL,
+                           firstPage=(after is None))
+
+# The aggregation behind role_matrix(): it joins each user's 
+# RoleAssignments on the (user, iscurrent, role) index, which is declared
+# without a _cls prefix for the raw $lookup, and keeps the current ones.
+# Retired assignments are joined too, until archived.
+def role_matrix_pipeline(after=None, limit=PAGE_SIZE):
+    match = {'iscurrent': True}
+    if after is not None:
+        match['username'] = {'$gt': after}
+    pipeline = [{'$match': match},
+                {'$sort': {'username': 1}},
+                {'$limit': limit},
+                {'$project': {'_id': 1, 'username': 1}},
+                {'$lookup': {
+                    'from': db.RoleAssignment._get_collection_name(),
+                    'localField': '_id',
+                    'foreignField': 'user',
+                    'as': 'roles'}},
+                {'$project': {'_id': 0, 'username': 1, 
+                              'roles': {'$filter': {
+                                  'input': '$roles', 'as': 'role',
+                                  'cond': '$$role.iscurrent'}}}}]
+    return pipeline
+
+# Current users (after the given username, in username order) with their
+# current roles, as [username, [role, ...]] pairs, from one aggregation
+# instead of dereferencing User.roleassignments one at a time.
+def role_matrix(after=None, limit=PAGE_SIZE):
+    return [[doc['username'], sorted(role['role'] for role in doc['roles'])]
+            for doc in db.User._get_collection().aggregate(
+                    role_matrix_pipeline(after, limit))]
+
+# Changes of roles per bulk write batch
+ROLE_BATCH_SIZE = 1000
+
+# Apply many role changes at once, from an uploaded CSV (with a 
+# username,role,action header) or JSON file on the roles page, or from a
+# JSON request body: a list of {"username", "role", "action"} objects 
+# where action is add or remove. JSON requests get a JSON summary.
+@mongomanager.route('/roles/bulk', methods=['POST'])
+@requires_perm('admin')
+def bulk_roles():
+    if request.is_json:
+        stream = io.BytesIO(request.get_data())
+        fmt = 'json'
+    else:
+        form = forms.BulkRoleForm()
+        if not form.validate():
+            for error in form.changes.errors:
+                flash(error)
+            return redirect(url_for('.roles'))
+        stream = form.changes.data.stream
+        fmt = ('json' if form.changes.data.filename.lower().endswith('.json')
+               else 'csv')
+    try:
+        changes, errors = rolechanges.parse_changes(stream, fmt)
+    except (ValueError, csv.Error) as e:
+        changes, errors = [], ['Unable to parse the changes: ' + str(e)]
+    result = rolechanges.apply_changes(changes, get_current_user(),
+                                       ROLE_BATCH_SIZE, invalidate_roles)
+    result['errors'] = errors + result['errors']
+    if request.is_json:
+        return jsonify(result)
+    flash('Added %d, removed %d, skipped %d role assignments.' % 
+          (result['added'], result['removed'], result['skipped']))
+    for error in result['errors']:
+        flash(error)
+    return redirect(url_for('.roles'))
 
+
+# Command line tools, run as: flask mongomanager <command>
+
+@mongomanager.cli.command('ingest')
+@click.argument('root', type=click.Path(exists=True, file_okay=False))
+@click.argument('basepath', type=click.Path(file_okay=False))
+@click.option('--user', 'username', required=True, 
+              help='Username recorded as addedby.')
+@click.option('--processes', type=int, default=None,
+              help='Hashing processes (default: one per CPU).')
+@click.option('--link', is_flag=True, 
+              help='Hard link files into the store instead of copying.')
+@click.option('--batch-size', type=int, default=1000,
+              help='File documents inserted per batch.')
+@click.option('--state', default=None, type=click.Path(dir_okay=False),
+              help='File recording ingested paths, to resume a run.')
+def ingest_command(root, basepath, username, processes, link, 
+                   batch_size, state):
+    """Ingest every file under ROOT into the File store at BASEPATH."""
+    user = db.User.objects(username=username, iscurrent=True).first()
+    if user is None:
+        raise click.BadParameter('User not found.', param_hint='--user')
+    def progress(files, nbytes, errors, seconds):
+        seconds = max(seconds, 1e-6)
+        click.echo('%d files, %.1f MB, %d errors '
+                   '(%.0f files/s, %.1f MB/s)' % 
+                   (files, nbytes/1e6, errors, files/seconds, 
+                    nbytes/1e6/seconds))
+    ingest.ingest_tree(root, os.path.abspath(basepath), user, 
+                       processes=processes, link=link, 
+                       batchsize=batch_size, statefile=state, 
+                       progress=progress)
+
+@mongomanager.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    """Create the indexes declared on every Document class."""
+    for classObj in document_classes():
+        classObj.ensure_indexes()
+        click.echo('Ensured indexes for ' + classObj.__name__)
+
+@mongomanager.cli.command('compact')
+@click.argument('basepath', type=click.Path(file_okay=False))
+@click.option('--threshold', type=float, default=0.5,
+              help='Rewrite segments with less than this fraction live.')
+@click.option('--grace', type=int, default=3600,
+              help='Keep unreferenced objects younger than this (seconds).')
+def compact_command(basepath, threshold, grace):
+    """Reclaim the space of unreferenced objects in BASEPATH's segments."""
+    basepath = os.path.abspath(basepath)
+    # Documents may hold the basepath in another form, e.g. with a 
+    # trailing slash. Without any, every object would look unreferenced.
+    aliases = verify.basepath_aliases([basepath])[basepath]
+    if len(aliases) == 0:
+        raise click.ClickException('No File documents use ' + basepath)
+    # Objects are written before their documents are saved, hence the
+    # grace period for objects nobody references yet
+    before = time.time() - grace
+    live = set(db.File.objects(storage='segment', basepath__in=aliases)
+               .scalar('hashstring'))
+    live.update(archive.history_objects(db.File)(storage='segment', 
+                                                 basepath__in=aliases)
+                .scalar('hashstring'))
+    reclaimed = segments.get_store(basepath).compact(
+            lambda hashstring: hashstring in live, before, threshold)
+    click.echo('Reclaimed %.1f MB' % (reclaimed/1e6))
+
+# Documents retired for longer than MONGOMANAGER_ARCHIVE_DAYS are moved
+# to the history collections by the archive command
+ARCHIVE_DAYS = 90
+
+@mongomanager.cli.command('archive')
+@click.option('--days', type=int, default=None,
+              help='Archive documents retired more than this many days ago '
+                   '(default: MONGOMANAGER_ARCHIVE_DAYS, or %d).' % 
+                   ARCHIVE_DAYS)
+@click.option('--class', 'classNames', multiple=True,
+              help='Only archive this class (may be repeated).')
+@click.option('--batch-size', type=int, default=1000,
+              help='Documents moved per batch.')
+def archive_command(days, classNames, batch_size):
+    """Move long retired documents to the history collections."""
+    if days is None:
+        days = current_app.config.get('MONGOMANAGER_ARCHIVE_DAYS', 
+                                      ARCHIVE_DAYS)
+    classes = document_classes()
+    if len(classNames) > 0:
+        unknown = set(classNames) - set(models.keys())
+        if len(unknown) > 0:
+            raise click.BadParameter('Unknown class: ' + 
+                                     ', '.join(sorted(unknown)),
+                                     param_hint='--class')
+        classes = [models[className] for className in classNames]
+    before = datetime.utcnow() - timedelta(days=days)
+    def keys(classObj):
+        return [(classObj._fields[key].db_field, direction) 
+                for key, direction in sort_keys(classObj)]
+    def progress(moved, seconds):
+        click.echo('%d documents moved (%.0f/s)' % 
+                   (moved, moved/max(seconds, 1e-6)))
+    counts = archive.archive_all(classes, before, batch_size, keys, 
+                                 progress)
+    for className, count in sorted(counts.items()):
+        click.echo('Archived %d %s documents' % (count, className))
+
+@mongomanager.cli.command('verify')
+@click.argument('basepaths', nargs=-1, type=click.Path(file_okay=False))
+@click.option('--processes', type=int, default=None,
+              help='Hashing processes (default: one per CPU).')
+@click.option('--rate', type=float, default=None,
+              help='Most MB/s to read, across all processes.')
+@click.option('--state', default=None, type=click.Path(dir_okay=False),
+              help='Checkpoint file, to carry on from the last run.')
+@click.option('--report', 'reportFile', default=None, 
+              type=click.File('a'),
+              help='Append problems to this file as NDJSON.')
+@click.option('--max-minutes', type=float, default=None,
+              help='Stop (and checkpoint) after this long.')
+@click.option('--repair', is_flag=True,
+              help='Quarantine corrupt and orphaned files and retire the '
+                   'documents of corrupt or missing ones.')
+@click.option('--grace', type=int, default=3600,
+              help='Ignore unreferenced files younger than this (seconds).')
+def verify_command(basepaths, processes, rate, state, reportFile, 
+                   max_minutes, repair, grace):
+    """Re-hash the File store and report corrupt, orphaned and dangling
+    entries. Checks every basepath in use unless BASEPATHS are given."""
+    if len(basepaths) == 0:
+        basepaths = sorted(set(os.path.abspath(basepath) for collection
+                               in verify.file_collections()
+                               for basepath in collection.distinct('basepath')
+                               if basepath))
+    def report(entry):
+        line = json.dumps(entry)
+        if reportFile is not None:
+            reportFile.write(line + '\n')
+            reportFile.flush()
+        else:
+            click.echo(line)
+    deadline = None
+    if max_minutes is not None:
+        deadline = time.time() + max_minutes*60
+    verifier = verify.Verifier(basepaths, report, processes=processes,
+                               rate=rate*1e6 if rate else None, 
+                               statefile=state, repair=repair, 
+                               grace=grace, deadline=deadline)
+    finished = verifier.run()
+    for basepath in verifier.basepaths:
+        if repair and not verifier.repairable(basepath):
+            click.echo('Not repaired, no File documents use ' + basepath)
+    counts = verifier.state['counts']
+    click.echo('%s: %d checked (%.1f MB), %d corrupt, %d orphaned, '
+               '%d dangling, %d errors' % 
+               ('Finished' if finished else 'Stopped, run again to carry on',
+                counts['checked'], counts['bytes']/1e6, counts['corrupt'], 
+                counts['orphan'], counts['dangling'], counts['errors']))
@@ -0,0 +1,109 @@
+# preview.py
+#
+# Bounded pretty printing of large JSON files. The text is re-indented
+# as it is read, a chunk at a time, so neither the parsed document nor
+# the whole file is ever held in memory. Output stops after a size limit,
+# and containers nested deeper than a depth limit are collapsed to
+# {...} or [...].
+#
+import re
+
+INDENT = '    '
+TRUNCATED = '\n... (truncated)\n'
+COLLAPSED = '...'
+
+_stringEnd = re.compile(r'[\\"]')
+_whitespace = re.compile(r'\s*')
+_literal = re.compile(r'[^\s{}\[\],:"]+')
+
+# Reformat JSON read from the text file infile into outfile, writing at
+# most limit characters. Returns (truncated, collapsed).
+def json_preview(infile, outfile, limit, maxdepth, chunksize=65536):
+    out = []
+    written = 0
+    depth = 0
+    collapseDepth = None # Depth of the container being skipped
+    collapsed = False
+    inString = False
+    escape = False
+    pendingOpen = False  # An opening bracket waiting for its newline
+
+    def emit(text):
+        if collapseDepth is None:
+            out.append(text)
+
+    for text in iter(lambda: infile.read(chunksize), ''):
+        i = 0
+        n = len(text)
+        while i < n:
+            if inString:
+                start = i
+                if escape:
+                    escape = False
+                    i += 1
+                    emit(text[start:i])
+                    continue
+                m = _stringEnd.search(text, i)
+                if m is None:
+                    i = n
+                else:
+                    i = m.end()
+                    if m.group() == '\\':
+                        escape = True
+                    else:
+                        inString = False
+                emit(text[start:i])
+                continue
+            i = _whitespace.match(text, i).end()
+            if i >= n:
+                break
+            c = text[i]
+            wasOpen = pendingOpen
+            if pendingOpen:
+                pendingOpen = False
+                if c not in '}]':
+                    emit('\n' + INDENT*depth)
+            if c == '"':
+                inString = True
+                emit(c)
+                i += 1
+            elif c in '{[':
+                if collapseDepth is None and depth >= maxdepth:
+                    emit(c + COLLAPSED)
+                    collapseDepth = depth
+                    collapsed = True
+                else:
+                    emit(c)
+                    pendingOpen = True
+                depth += 1
+                i += 1
+            elif c in '}]':
+                depth -= 1
+                if collapseDepth is not None and depth == collapseDepth:
+                    collapseDepth = None
+                    emit(c)
+                elif wasOpen:
+                    emit(c)
+                else:
+                    emit('\n' + INDENT*depth + c)
+                i += 1
+            elif c == ',':
+                emit(',\n' + INDENT*depth)
+                i += 1
+            elif c == ':':
+                emit(': ')
+                i += 1
+            else:
+                m = _literal.match(text, i)
+                emit(m.group())
+                i = m.end()
+        chunk = ''.join(out)
+        out = []
+        if written + len(chunk) > limit:
+            outfile.write(chunk[:limit - written])
+            outfile.write(TRUNCATED)
+            return True, collapsed
+        outfile.write(chunk)
+        written += len(chunk)
+    outfile.write('\n')
+    return False, collapsed
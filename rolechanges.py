@@ -0,0 +1,126 @@
+# rolechanges.py
+#
+# Bulk role changes: a list of (username, role, add|remove) changes read
+# from CSV or JSON and applied in batches, each with one query to resolve
+# the users, one for their current role assignments, and bulk writes for
+# the new and retired assignments.
+#
+import io, re, csv, json
+from datetime import datetime
+from pymongo import UpdateOne
+
+import database as db
+
+ACTIONS = ('add', 'remove')
+ROLE_PATTERN = re.compile(r'^[\w]+$')
+
+# Parse changes from a binary stream of CSV (with a username,role,action
+# header) or JSON (a list of {"username", "role", "action"} objects).
+# Returns (changes, errors); errors are strings naming the bad row.
+def parse_changes(stream, fmt):
+    if fmt == 'json':
+        rows = json.load(io.TextIOWrapper(stream, encoding='utf-8'))
+        if not isinstance(rows, list):
+            return [], ['Expected a JSON list of changes.']
+    else:
+        rows = list(csv.DictReader(io.TextIOWrapper(stream,
+                                                    encoding='utf-8',
+                                                    newline='')))
+    changes = []
+    errors = []
+    for number, row in enumerate(rows, 1):
+        if not isinstance(row, dict):
+            errors.append('Row %d: not an object.' % number)
+            continue
+        username = str(row.get('username') or '').strip()
+        role = str(row.get('role') or '').strip()
+        action = str(row.get('action') or '').strip().lower()
+        if username == '' or not ROLE_PATTERN.match(role):
+            errors.append('Row %d: needs a username and an alphanumeric '
+                          'role.' % number)
+        elif action not in ACTIONS:
+            errors.append('Row %d: action must be add or remove.' % number)
+        else:
+            changes.append((username, role, action))
+    return changes, errors
+
+# Apply changes as addedby/removedby, batchsize at a time, calling
+# invalidate() after each batch is written. Adding a role the user
+# already has, or removing one they don't, is skipped. Returns a dict of
+# added, removed and skipped counts and a list of errors.
+def apply_changes(changes, user, batchsize=1000, invalidate=None):
+    result = dict(added=0, removed=0, skipped=0, errors=[])
+    for start in range(0, len(changes), batchsize):
+        _apply_batch(changes[start:start + batchsize], user, result)
+        if invalidate is not None:
+            invalidate()
+    return result
+
+def _apply_batch(batch, user, result):
+    users = dict((doc['username'], doc['_id']) for doc
+                 in db.User._get_collection().find(
+                        {'username': {'$in': list(set(username for
+                                           username, role, action
+                                           in batch))},
+                         'iscurrent': True}, {'username': 1}))
+    # Current assignment ids by (userid, role)
+    current = dict()
+    for doc in db.RoleAssignment._get_collection().find(
+            {'user': {'$in': list(users.values())}, 'iscurrent': True},
+            {'user': 1, 'role': 1}):
+        current.setdefault((doc['user'], doc['role']), 
+                           []).append(doc['_id'])
+    pending = dict(adds=[], removes=[], pairs=set())
+
+    # Write the pending changes. A pair is only touched once per flush,
+    # so the writes within one don't depend on each other's order.
+    def flush():
+        now = datetime.utcnow()
+        if len(pending['adds']) > 0:
+            ids = db.RoleAssignment.objects.insert(
+                    [roleAssignment for pair, roleAssignment
+                     in pending['adds']], load_bulk=False)
+            pushes = dict()
+            for (pair, roleAssignment), id in zip(pending['adds'], ids):
+                pushes.setdefault(pair[0], []).append(id)
+                current.setdefault(pair, []).append(id)
+            db.User._get_collection().bulk_write(
+                    [UpdateOne({'_id': userid},
+                               {'$push': {'roleassignments': 
+                                              {'$each': userIds}},
+                                '$set': {'modifieddate': now}})
+                     for userid, userIds in pushes.items()], ordered=False)
+            result['added'] += len(ids)
+        if len(pending['removes']) > 0:
+            db.RoleAssignment._get_collection().update_many(
+                    {'_id': {'$in': pending['removes']}, 'iscurrent': True},
+                    {'$set': {'iscurrent': False, 'removedby': user.id,
+                              'removeddate': now, 'modifieddate': now}})
+            result['removed'] += len(pending['removes'])
+        pending['adds'] = []
+        pending['removes'] = []
+        pending['pairs'] = set()
+
+    for username, role, action in batch:
+        userid = users.get(username)
+        if userid is None:
+            result['errors'].append('User does not exist: ' + username)
+            continue
+        pair = (userid, role)
+        if pair in pending['pairs']:
+            flush()
+        if action == 'add':
+            if len(current.get(pair, [])) > 0:
+                result['skipped'] += 1
+                continue
+            pending['adds'].append((pair, db.RoleAssignment(
+                    role=role, user=userid, addedby=user,
+                    addeddate=datetime.utcnow(), iscurrent=True)))
+        else:
+            ids = current.pop(pair, [])
+            if len(ids) == 0:
+                result['skipped'] += 1
+                continue
+            pending['removes'].extend(ids)
+        pending['pairs'].add(pair)
+    flush()
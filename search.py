@@ -0,0 +1,173 @@
+# search.py
+#
+# The collection page's query bar. A query is a list of terms separated
+# by spaces (quote values that contain spaces):
+#
+#   field:value  field=value    equality (a date matches the whole day)
+#   field:abc*                  prefix of a string field
+#   field>value  field>=value   ranges, also < and <=
+#   word                        prefix of the name, username or filename
+#                               field, an id, or with a text index on
+#                               the class, a $text search
+#
+# Values are converted to the field's type: true/false for booleans,
+# YYYY-MM-DD[THH:MM[:SS]] in the server's timezone for dates, and ids or
+# link text (e.g. addedby:alice) for references. Terms are combined with
+# $and into a raw filter on the db fields.
+#
+import re, shlex
+from datetime import datetime, timedelta
+import bson
+import pytz
+
+import database as db
+
+TERM_PATTERN = re.compile(r'^(\w+)(:|>=|<=|>|<|=)(.*)$', re.DOTALL)
+OPERATORS = {'>': '$gt', '>=': '$gte', '<': '$lt', '<=': '$lte'}
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M',
+                '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S')
+PREFIX_FIELDS = ('name', 'username', 'filename')
+# Fields used to look up references given by link text
+LINK_FIELDS = ('name', 'username', 'role')
+# Most referenced documents one reference term may match
+MAX_REFERENCES = 1000
+
+class SearchError(ValueError):
+    pass
+
+def text_indexed(classObj):
+    return any(direction == 'text'
+               for spec in classObj._meta.get('index_specs', [])
+               for key, direction in spec['fields'])
+
+def parse_bool(text):
+    if text.lower() in ('true', 'yes', '1'):
+        return True
+    if text.lower() in ('false', 'no', '0'):
+        return False
+    raise SearchError('Expected true or false: ' + text)
+
+# A local date or time as a naive UTC datetime, and whether only the date
+# was given
+def parse_datetime(text):
+    for fmt in DATE_FORMATS:
+        try:
+            value = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        value = value.astimezone(pytz.utc).replace(tzinfo=None)
+        return value, fmt == DATE_FORMATS[0]
+    raise SearchError('Expected a date (YYYY-MM-DD[THH:MM[:SS]]): ' + text)
+
+def parse_objectid(text):
+    if not bson.ObjectId.is_valid(text):
+        raise SearchError('Expected an id: ' + text)
+    return bson.ObjectId(text)
+
+def prefix_regex(text):
+    return {'$regex': '^' + re.escape(text)}
+
+# Ids of the documents a reference term names, by id or by link text
+def reference_ids(field, text):
+    if bson.ObjectId.is_valid(text):
+        return [bson.ObjectId(text)]
+    classObj = field.document_type
+    for key in LINK_FIELDS:
+        if key in classObj._fields:
+            dbkey = classObj._fields[key].db_field
+            if text.endswith('*'):
+                value = prefix_regex(text[:-1])
+            else:
+                value = text
+            return [doc['_id'] for doc in classObj._get_collection().find(
+                        {dbkey: value}, {'_id': 1}).limit(MAX_REFERENCES)]
+    raise SearchError('Expected an id: ' + text)
+
+# The raw condition on one field for a term
+def condition(classObj, key, op, text):
+    if key in ('id', '_id'):
+        field = classObj._fields.get('id')
+        dbkey = '_id'
+    elif key in classObj._fields:
+        field = classObj._fields[key]
+        dbkey = field.db_field
+    else:
+        raise SearchError('Unknown field: ' + key)
+    if isinstance(field, db.me.ListField):
+        field = field.field # Matches any element
+    if isinstance(field, db.me.ReferenceField):
+        if op in OPERATORS:
+            raise SearchError('References only match by id or name: ' +
+                              key)
+        return {dbkey: {'$in': reference_ids(field, text)}}
+    if isinstance(field, db.me.DateTimeField):
+        value, wholeDay = parse_datetime(text)
+        if op in OPERATORS:
+            if wholeDay and op in ('>', '<='):
+                # After (or up to the end of) the given day
+                value += timedelta(days=1)
+                op = {'>': '>=', '<=': '<'}[op]
+            return {dbkey: {OPERATORS[op]: value}}
+        if wholeDay:
+            return {dbkey: {'$gte': value,
+                            '$lt': value + timedelta(days=1)}}
+        return {dbkey: value}
+    if isinstance(field, db.me.BooleanField):
+        if op in OPERATORS:
+            raise SearchError('Booleans only match true or false: ' + key)
+        return {dbkey: parse_bool(text)}
+    if isinstance(field, db.me.ObjectIdField):
+        value = parse_objectid(text)
+    elif isinstance(field, (db.me.IntField, db.me.LongField)):
+        try:
+            value = int(text)
+        except ValueError:
+            raise SearchError('Expected a whole number: ' + text)
+    elif isinstance(field, (db.me.FloatField, db.me.DecimalField)):
+        try:
+            value = float(text)
+        except ValueError:
+            raise SearchError('Expected a number: ' + text)
+    else:
+        if op not in OPERATORS and text.endswith('*'):
+            return {dbkey: prefix_regex(text[:-1])}
+        value = text
+    if op in OPERATORS:
+        return {dbkey: {OPERATORS[op]: value}}
+    return {dbkey: value}
+
+# The raw condition for words without a field
+def words_condition(classObj, words):
+    if len(words) == 1 and bson.ObjectId.is_valid(words[0]):
+        return {'_id': bson.ObjectId(words[0])}
+    if text_indexed(classObj):
+        return {'$text': {'$search': ' '.join(words)}}
+    for key in PREFIX_FIELDS:
+        if key in classObj._fields:
+            return {classObj._fields[key].db_field:
+                    prefix_regex(' '.join(words).rstrip('*'))}
+    raise SearchError('Give a field to search, e.g. addedby:<username>')
+
+# Translate a query into a raw filter for classObj's collection, or None
+# for an empty query. Raises SearchError for queries it can't translate.
+def parse_search(classObj, text):
+    try:
+        terms = shlex.split(text or '')
+    except ValueError as e:
+        raise SearchError(str(e))
+    conditions = []
+    words = []
+    for term in terms:
+        match = TERM_PATTERN.match(term)
+        if match is None:
+            words.append(term)
+        else:
+            key, op, value = match.groups()
+            conditions.append(condition(classObj, key, op, value))
+    if len(words) > 0:
+        conditions.append(words_condition(classObj, words))
+    if len(conditions) == 0:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
@@ -0,0 +1,328 @@
+# segments.py
+#
+# Packed storage for small objects of the File store. Instead of one
+# file per object in the hashstring fan-out directories, objects are
+# appended to large segment files under <basepath>/.segments, and an
+# on-disk index (sqlite) maps each hash to (segment, offset, length).
+# Objects are read through mmap. Appends are serialized across threads
+# and processes with a lock file; compact() rewrites mostly dead
+# segments to reclaim space. Segment numbers come from a counter in the
+# index and are never reused, since other processes may still have a
+# removed segment mapped.
+#
+import os, io, mmap, time, fcntl, sqlite3, threading
+
+# Segments are closed for appends once they grow past this size
+SEGMENT_SIZE = 256*1024*1024
+CHUNKSIZE = 1024*1024
+
+_stores = dict()
+_storesLock = threading.Lock()
+
+# One store per basepath, shared within the process
+def get_store(basepath):
+    with _storesLock:
+        if basepath not in _stores:
+            _stores[basepath] = SegmentStore(basepath)
+        return _stores[basepath]
+
+# Read-only file object over a memoryview, so callers can stream an
+# object without copying it out of the mmap first.
+class SegmentReader(io.RawIOBase):
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = min(len(buffer), len(self._view) - self._pos)
+        buffer[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._view = memoryview(b'')
+        super(SegmentReader, self).close()
+
+class SegmentStore(object):
+    def __init__(self, basepath, segmentsize=SEGMENT_SIZE):
+        self.path = os.path.join(basepath, '.segments')
+        self.segmentsize = segmentsize
+        os.makedirs(self.path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._reset()
+        with self._writing() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS objects ('
+                       'hash TEXT PRIMARY KEY, segment INTEGER, '
+                       '"offset" INTEGER, length INTEGER, added REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS objects_segment '
+                       'ON objects (segment)')
+            db.execute('CREATE TABLE IF NOT EXISTS counters ('
+                       'name TEXT PRIMARY KEY, value INTEGER)')
+
+    # Connections and maps can't be shared with a forked child
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._maps = dict()
+
+    def _db(self):
+        if self._pid != os.getpid():
+            self._reset()
+        if not hasattr(self._local, 'db'):
+            self._local.db = sqlite3.connect(
+                    os.path.join(self.path, 'index.sqlite'), timeout=60)
+            self._local.db.execute('PRAGMA journal_mode=WAL')
+        return self._local.db
+
+    def segmentname(self, segment):
+        return os.path.join(self.path, '%08d.seg' % segment)
+
+    # Context manager holding the writer lock and an index transaction
+    class _Writing(object):
+        def __init__(self, store):
+            self.store = store
+        def __enter__(self):
+            self.store._lock.acquire()
+            self.lockfile = open(os.path.join(self.store.path, 'lock'), 'a')
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+            self.db = self.store._db()
+            return self.db
+        def __exit__(self, *exc):
+            try:
+                if exc[0] is None:
+                    self.db.commit()
+                else:
+                    self.db.rollback()
+            finally:
+                fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+                self.lockfile.close()
+                self.store._lock.release()
+
+    def _writing(self):
+        return SegmentStore._Writing(self)
+
+    def _counter(self, db, name):
+        row = db.execute('SELECT value FROM counters WHERE name = ?',
+                         (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _setcounter(self, db, name, value):
+        db.execute('INSERT OR REPLACE INTO counters VALUES (?, ?)',
+                   (name, value))
+
+    # Numbers of the segment files on disk
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.path)
+                      if name.endswith('.seg'))
+
+    def _size(self, segment):
+        try:
+            return os.path.getsize(self.segmentname(segment))
+        except FileNotFoundError:
+            return 0
+
+    # A segment number that has never been used. Stores created before
+    # the counter start it after their highest segment.
+    def _allocate(self, db):
+        segment = self._counter(db, 'next')
+        if segment is None:
+            row = db.execute('SELECT MAX(segment) FROM objects').fetchone()
+            segment = max([row[0] or 0] + self._segments()) + 1
+        self._setcounter(db, 'next', segment + 1)
+        return segment
+
+    # The segment put() appends to, starting a new one when it's full
+    def _active(self, db):
+        segment = self._counter(db, 'active')
+        if segment is None or self._size(segment) >= self.segmentsize:
+            segment = self._allocate(db)
+            self._setcounter(db, 'active', segment)
+        return segment
+
+    def _append(self, segment, source):
+        with open(self.segmentname(segment), 'ab') as f:
+            offset = f.tell()
+            while True:
+                chunk = source.read(CHUNKSIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        return offset
+
+    # (segment, offset, length) of an object, or None
+    def lookup(self, hashstring):
+        return self._db().execute(
+                'SELECT segment, "offset", length FROM objects '
+                'WHERE hash = ?', (hashstring,)).fetchone()
+
+    # Append the contents of a file under hashstring. Returns
+    # (stored, length): if the hash is already present nothing is
+    # written and the existing object's length is returned. Its added
+    # time is refreshed either way, so compaction's grace period covers
+    # a new reference to an object that was unreferenced until now.
+    def put(self, hashstring, filename, length):
+        with self._writing() as db:
+            row = db.execute('SELECT length FROM objects WHERE hash = ?',
+                             (hashstring,)).fetchone()
+            if row is not None:
+                db.execute('UPDATE objects SET added = ? WHERE hash = ?',
+                           (time.time(), hashstring))
+                return False, row[0]
+            segment = self._active(db)
+            with open(filename, 'rb') as source:
+                offset = self._append(segment, source)
+            db.execute('INSERT INTO objects VALUES (?, ?, ?, ?, ?)',
+                       (hashstring, segment, offset, length, time.time()))
+            return True, length
+
+    # The mmap of a segment, covering at least end bytes. A cached map is
+    # only used while the segment file is the one it mapped, and maps of
+    # removed segments are dropped whenever a segment is mapped.
+    def _map(self, segment, end):
+        try:
+            stat = os.stat(self.segmentname(segment))
+        except FileNotFoundError:
+            self._maps.pop(segment, None)
+            raise
+        cached = self._maps.get(segment)
+        if (cached is not None and cached[1] == (stat.st_dev, stat.st_ino)
+                and len(cached[0]) >= end):
+            return cached[0]
+        for other in list(self._maps):
+            if not os.path.exists(self.segmentname(other)):
+                self._maps.pop(other, None)
+        with open(self.segmentname(segment), 'rb') as f:
+            stat = os.fstat(f.fileno())
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[segment] = (mapped, (stat.st_dev, stat.st_ino))
+        return mapped
+
+    # A memoryview of an object's bytes, straight from the mmap
+    def view(self, hashstring):
+        for attempt in range(2):
+            location = self.lookup(hashstring)
+            if location is None:
+                raise KeyError(hashstring)
+            segment, offset, length = location
+            try:
+                mapped = self._map(segment, offset + length)
+            except FileNotFoundError:
+                # Compacted away between the lookup and the map
+                self._maps.pop(segment, None)
+                continue
+            return memoryview(mapped)[offset:offset + length]
+        raise KeyError(hashstring)
+
+    def open(self, hashstring):
+        return SegmentReader(self.view(hashstring))
+
+    def samecontents(self, hashstring, filename):
+        view = self.view(hashstring)
+        with open(filename, 'rb') as f:
+            return f.read() == view
+
+    # Up to limit (hash, added) pairs in hash order, after the given hash
+    def hashes(self, after='', limit=1000):
+        return self._db().execute('SELECT hash, added FROM objects WHERE '
+                                  'hash > ? ORDER BY hash LIMIT ?',
+                                  (after, limit)).fetchall()
+
+    # Drop an object from the index; compact() reclaims its space
+    def remove(self, hashstring):
+        with self._writing() as db:
+            db.execute('DELETE FROM objects WHERE hash = ?', (hashstring,))
+
+    # Drop index entries for objects no longer referenced (islive(hash)
+    # returns False) that were added before `before` (a time.time()),
+    # then rewrite segments whose live fraction is below threshold into
+    # new segments. The writer lock is only held to drop the entries and
+    # to point the index at the copies, not while copying, so puts carry
+    # on meanwhile; entries that changed during the copy are left alone.
+    # Returns the number of bytes reclaimed.
+    def compact(self, islive, before, threshold=0.5):
+        with open(os.path.join(self.path, 'compact.lock'), 'a') as lockfile:
+            # One compaction per store at a time
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                return self._compact(islive, before, threshold)
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _compact(self, islive, before, threshold):
+        with self._writing() as db:
+            dead = [row[0] for row in
+                    db.execute('SELECT hash FROM objects WHERE added < ?',
+                               (before,)) if not islive(row[0])]
+            db.executemany('DELETE FROM objects WHERE hash = ?',
+                           [(hashstring,) for hashstring in dead])
+            # Only the active segment is appended to by put()
+            active = self._active(db)
+            candidates = [segment for segment in self._segments()
+                          if segment != active]
+        index = self._db()
+        reclaimed = 0
+        target = None
+        targetFile = None
+        try:
+            for segment in candidates:
+                size = self._size(segment)
+                live = index.execute('SELECT COALESCE(SUM(length), 0) FROM '
+                                     'objects WHERE segment = ?',
+                                     (segment,)).fetchone()[0]
+                if size > 0 and float(live)/size >= threshold:
+                    continue
+                rows = index.execute('SELECT hash, "offset", length FROM '
+                                     'objects WHERE segment = ? ORDER BY '
+                                     '"offset"', (segment,)).fetchall()
+                moved = []
+                with open(self.segmentname(segment), 'rb') as source:
+                    for hashstring, offset, length in rows:
+                        if (targetFile is None or 
+                                targetFile.tell() >= self.segmentsize):
+                            if targetFile is not None:
+                                targetFile.close()
+                            with self._writing() as db:
+                                target = self._allocate(db)
+                            targetFile = open(self.segmentname(target), 
+                                              'ab')
+                        source.seek(offset)
+                        moved.append((target, targetFile.tell(), 
+                                      hashstring, segment, offset))
+                        targetFile.write(source.read(length))
+                if targetFile is not None:
+                    targetFile.flush()
+                    os.fsync(targetFile.fileno())
+                with self._writing() as db:
+                    db.executemany('UPDATE objects SET segment = ?, '
+                                   '"offset" = ? WHERE hash = ? AND '
+                                   'segment = ? AND "offset" = ?', moved)
+                    remaining = db.execute('SELECT COUNT(*) FROM objects '
+                                           'WHERE segment = ?',
+                                           (segment,)).fetchone()[0]
+                    if remaining == 0:
+                        self._maps.pop(segment, None)
+                        os.remove(self.segmentname(segment))
+                        reclaimed += size - live
+        finally:
+            if targetFile is not None:
+                targetFile.close()
+        return reclaimed
@@ -0,0 +1,41 @@
+# conftest.py
+#
+# The tests use the layout the README describes: the blueprint imported as
+# the mongomanager package, and a project database.py (tests/database.py)
+# importing its classes. They run against an in-memory mongomock database.
+#
+import os, sys, importlib.util
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The clone may not be named mongomanager, so import it by path
+if 'mongomanager' not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+            'mongomanager', os.path.join(ROOT, '__init__.py'),
+            submodule_search_locations=[ROOT])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules['mongomanager'] = package
+    spec.loader.exec_module(package)
+
+@pytest.fixture(scope='session')
+def connection():
+    pytest.importorskip('mongomock')
+    import mongoengine as me
+    me.connect('mongomanager-test', host='mongomock://localhost')
+    yield
+    me.disconnect()
+
+# A user to add documents as, in an emptied database
+@pytest.fixture
+def user(connection):
+    import database as db
+    import mongomanager.archive as archive
+    for classObj in (db.User, db.RoleAssignment, db.File):
+        classObj.drop_collection()
+        archive.history_collection(classObj).drop()
+    newUser = db.User(addedby='self', username='alice', firstname='A',
+                      lastname='B', email='a@b.c', passwordhash='x')
+    newUser.save()
+    newUser.update(addedby=newUser)
+    return newUser
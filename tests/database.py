@@ -0,0 +1,2 @@
+# The project's database module, as in the README
+from mongomanager.database import *
@@ -0,0 +1,49 @@
+import os, time
+
+from mongomanager.cache import DiskCache
+
+def entries(path):
+    return sorted(name for dirpath, dirnames, filenames in os.walk(path)
+                  for name in filenames)
+
+def test_disk_cache_honours_ttl(tmp_path):
+    cache = DiskCache(str(tmp_path), ttl=60)
+    cache.set('default', 'a')
+    cache.set('short', 'b', ttl=-1)
+    cache.set('long', 'c', ttl=3600)
+    assert cache.get('default') == 'a'
+    assert cache.get('short') is None
+    assert cache.get('long') == 'c'
+    expires = os.path.getmtime(cache.filename('long'))
+    assert time.time() + 3500 < expires <= time.time() + 3600
+
+def test_disk_cache_sweeps_expired_entries(tmp_path):
+    cache = DiskCache(str(tmp_path), ttl=60, maxsize=100)
+    for i in range(5):
+        cache.set(('old', i), 'x', ttl=-1)
+    cache.set('live', 'y')
+    cache.sweep()
+    assert entries(str(tmp_path)) == [os.path.basename(
+                                          cache.filename('live'))]
+
+def test_disk_cache_is_bounded(tmp_path):
+    cache = DiskCache(str(tmp_path), ttl=60, maxsize=20)
+    for i in range(100):
+        cache.set(i, str(i), ttl=60 + i)
+    assert len(entries(str(tmp_path))) <= 20 + 20//DiskCache.SWEEP_DIVISOR
+    # The entries kept longest are the last ones set
+    assert cache.get(99) == '99'
+    assert cache.get(0) is None
+
+def test_disk_cache_keeps_files_being_written(tmp_path):
+    cache = DiskCache(str(tmp_path), ttl=60)
+    cache.set('a', 'x')
+    partial = os.path.join(os.path.dirname(cache.filename('a')),
+                           DiskCache.TEMP_PREFIX + 'partial')
+    with open(partial, 'w') as f:
+        f.write('x')
+    cache.sweep()
+    assert os.path.exists(partial)
+    os.utime(partial, (time.time() - 2*DiskCache.TEMP_AGE,)*2)
+    cache.sweep()
+    assert not os.path.exists(partial)
@@ -0,0 +1,53 @@
+import pytest
+from functools import cmp_to_key
+
+@pytest.fixture
+def mm():
+    pytest.importorskip('flask')
+    from mongomanager import mongomanager
+    return mongomanager
+
+@pytest.fixture
+def Item(connection):
+    import mongoengine as me
+    class Item(me.Document):
+        iscurrent = me.BooleanField()
+        name = me.StringField()
+        meta = {'collection': 'keysetitem'}
+    Item.drop_collection()
+    for iscurrent in (True, False):
+        for name in (None, 'a', None, 'b', 'b'):
+            Item(iscurrent=iscurrent, name=name).save()
+    return Item
+
+# Seek a page at a time past the last row, as the collection view does
+def paginate(mm, classObj, keys, pagesize):
+    rows, cursor = [], None
+    while True:
+        query = classObj.objects()
+        if cursor is not None:
+            query = query(__raw__=mm.keyset_query(
+                            classObj, keys, mm.decode_cursor(cursor)))
+        page = list(query.order_by(*mm.sort_order(keys)).limit(pagesize))
+        if len(page) == 0:
+            return rows
+        rows.extend(page)
+        cursor = mm.encode_cursor(page[-1], keys)
+
+@pytest.mark.parametrize('direction', [1, -1])
+@pytest.mark.parametrize('pagesize', [1, 2, 3])
+def test_missing_sort_values(mm, Item, direction, pagesize):
+    keys = [('iscurrent', -1), ('name', direction), ('id', 1)]
+    expected = list(Item.objects().order_by(*mm.sort_order(keys)))
+    assert [item.name for item in expected[:5]] == \
+            ([None, None, 'a', 'b', 'b'] if direction > 0 else
+             ['b', 'b', 'a', None, None])
+    assert paginate(mm, Item, keys, pagesize) == expected
+
+@pytest.mark.parametrize('direction', [1, -1])
+def test_compare_rows_orders_missing_first(mm, Item, direction):
+    keys = [('iscurrent', -1), ('name', direction), ('id', 1)]
+    expected = list(Item.objects().order_by(*mm.sort_order(keys)))
+    merged = sorted(reversed(expected), key=cmp_to_key(
+                lambda item1, item2: mm.compare_rows(item1, item2, keys)))
+    assert merged == expected
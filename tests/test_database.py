@@ -0,0 +1,10 @@
+import os, stat
+
+import database as db
+
+def test_stored_files_are_readable_by_others(user, tmp_path):
+    fileObj = db.File(addedby=user, basepath=str(tmp_path), filetype='bin')
+    assert fileObj.write(b'data')
+    mode = stat.S_IMODE(os.stat(fileObj.getstoredname()).st_mode)
+    assert mode == db.FILEMODE
+    assert mode & stat.S_IROTH or not db.FILEMODE & stat.S_IROTH
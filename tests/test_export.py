@@ -0,0 +1,58 @@
+import csv, io, json, zlib
+import pytest
+
+@pytest.fixture
+def mm():
+    pytest.importorskip('flask')
+    from mongomanager import mongomanager
+    return mongomanager
+
+COLUMNS = ['name', 'n']
+DBFIELDS = [('name', 'name'), ('n', 'n')]
+
+# Documents that record how many have been read
+class Docs(object):
+    def __init__(self, count):
+        self.count = count
+        self.read = 0
+
+    def __iter__(self):
+        for i in range(self.count):
+            self.read += 1
+            yield {'name': 'row %d' % i, 'n': i}
+
+def test_first_row_is_not_held_back(mm):
+    docs = Docs(10)
+    chunks = mm.export_rows(docs, 'ndjson', COLUMNS, DBFIELDS, 1000)
+    assert json.loads(next(chunks)) == {'name': 'row 0', 'n': 0}
+    assert docs.read == 1
+    assert ''.join(chunks).count('\n') == 9
+    docs = Docs(10)
+    chunks = mm.export_rows(docs, 'csv', COLUMNS, DBFIELDS, 1000)
+    assert next(chunks) == 'name,n\r\n'
+    assert docs.read == 0
+    assert next(chunks) == 'row 0,0\r\n'
+    assert docs.read == 1
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv'])
+def test_chunks_are_bounded(mm, fmt, monkeypatch):
+    monkeypatch.setattr(mm, 'EXPORT_CHUNK_SIZE', 100)
+    chunks = list(mm.export_rows(Docs(1000), fmt, COLUMNS, DBFIELDS, 1000))
+    assert max(len(chunk) for chunk in chunks) < 200
+    text = ''.join(chunks)
+    if fmt == 'csv':
+        rows = list(csv.reader(io.StringIO(text)))
+        assert rows[0] == COLUMNS and len(rows) == 1001
+    else:
+        assert [json.loads(line)['n'] for line in text.splitlines()] == \
+                list(range(1000))
+
+# Each gzip chunk decompresses completely as soon as it is sent
+def test_gzip_flushes_each_chunk(mm):
+    chunks = ['first\n', 'second\n', '', 'third\n']
+    decompressor = zlib.decompressobj(31)
+    received = []
+    for data in mm.gzip_chunks(iter(chunks)):
+        received.append(decompressor.decompress(data).decode('utf-8'))
+    assert received[:len(chunks)] == chunks
+    assert decompressor.eof
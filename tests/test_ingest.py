@@ -0,0 +1,37 @@
+import os
+
+import mongomanager.ingest as ingest
+
+def make_tree(root, files):
+    for name, data in files.items():
+        filename = os.path.join(str(root), name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+def stored(basepath):
+    import database as db
+    return sorted((fileObj.hashstring, fileObj.filetype) for fileObj
+                  in db.File.objects(basepath=basepath, iscurrent=True))
+
+# A run interrupted after inserting a batch but before recording it in
+# the state file is resumed without duplicating its File documents
+def test_resume_does_not_duplicate(user, tmp_path):
+    root, basepath = tmp_path / 'src', str(tmp_path / 'store')
+    make_tree(root, {'a.txt': b'a', 'b.txt': b'b', 'sub/c.txt': b'a',
+                     'd.json': b'a'})
+    statefile = str(tmp_path / 'state')
+    assert ingest.ingest_tree(str(root), basepath, user, processes=1,
+                              batchsize=2, statefile=statefile)[0] == 4
+    expected = stored(basepath)
+    assert len(expected) == 3
+    with open(statefile) as f:
+        lines = f.readlines()
+    assert len(lines) == 4
+    with open(statefile, 'w') as f:
+        f.writelines(lines[:2])
+    assert ingest.ingest_tree(str(root), basepath, user, processes=1,
+                              statefile=statefile)[0] == 2
+    assert stored(basepath) == expected
+    with open(statefile) as f:
+        assert len(f.readlines()) == 4
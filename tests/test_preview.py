@@ -0,0 +1,74 @@
+import io, json
+import pytest
+
+import mongomanager.preview as preview
+
+def format_json(text, limit=1000, depth=8, chunksize=65536):
+    outfile = io.StringIO()
+    flags = preview.json_preview(io.StringIO(text), outfile, limit, depth,
+                                 chunksize)
+    return (outfile.getvalue(),) + flags
+
+PRETTY = '{\n    "a": 1\n}'
+
+def test_pretty_prints():
+    assert format_json('{"a":1}') == (PRETTY + '\n', False, False)
+
+@pytest.mark.parametrize('chunksize', [1, 3, 65536])
+def test_truncates_at_the_limit(chunksize):
+    text = '{"a":1}'
+    assert format_json(text, len(PRETTY), chunksize=chunksize) == \
+            (PRETTY + '\n', False, False)
+    assert format_json(text, len(PRETTY) - 1, chunksize=chunksize) == \
+            (PRETTY[:-1] + preview.TRUNCATED, True, False)
+
+def test_collapses_at_depth():
+    text = '{"a": {"b": [1, 2]}, "c": []}'
+    output, truncated, collapsed = format_json(text, depth=1)
+    assert json.loads(output.replace(preview.COLLAPSED, '')) == \
+            {'a': {}, 'c': []}
+    assert collapsed and not truncated
+    output, truncated, collapsed = format_json(text, depth=2)
+    assert '"b": [' + preview.COLLAPSED + ']' in output
+    assert collapsed
+    output, truncated, collapsed = format_json(text, depth=3)
+    assert json.loads(output) == json.loads(text)
+    assert not collapsed
+
+def test_strings_are_not_reformatted():
+    text = '{"s": "[...] {x: [1,2]}\\"", "t": "\\\\"}'
+    output, truncated, collapsed = format_json(text, depth=1)
+    assert json.loads(output) == json.loads(text)
+    assert not collapsed
+
+@pytest.fixture
+def mm():
+    pytest.importorskip('flask')
+    from mongomanager import mongomanager
+    return mongomanager
+
+# The flags come from the formatter, not from the text
+def test_cached_preview_flags(mm, user, tmp_path):
+    import database as db
+    fileObj = db.File(addedby=user, basepath=str(tmp_path), 
+                      filetype='json')
+    assert fileObj.write(b'{"s": "[...]", "t": "...\\n... (truncated)\\n"}')
+    for attempt in range(2):
+        text, truncated, collapsed = mm.json_preview(fileObj, 1000, 8)
+        assert json.loads(text)['s'] == '[...]'
+        assert not truncated and not collapsed
+    text, truncated, collapsed = mm.json_preview(fileObj, 10, 8)
+    assert truncated and not collapsed
+
+def test_preview_limits_round_up_the_ladder(mm):
+    default = mm.PREVIEW_SIZE
+    assert mm.preview_limit(1, default) == default
+    assert mm.preview_limit(default + 1, default) == default*4
+    assert mm.preview_limit(default*4, default) == default*4
+    assert mm.preview_limit(10**12, default) == mm.MAX_PREVIEW_SIZE
+
+def test_preview_depths_round_up_the_ladder(mm):
+    default = mm.PREVIEW_DEPTH
+    assert mm.preview_depth(-5, default) == default
+    assert mm.preview_depth(default + 1, default) == default + 4
+    assert mm.preview_depth(10**6, default) == mm.MAX_PREVIEW_DEPTH
@@ -0,0 +1,13 @@
+import pytest
+
+pytest.importorskip('flask')
+from mongomanager import mongomanager as mm
+
+# The registry is normally built when the blueprint is registered, and 
+# otherwise on first use
+def test_registry_builds_without_registration(monkeypatch):
+    monkeypatch.setattr(mm, 'models', mm.OrderedDict())
+    classes = dict((classObj.__name__, classObj) 
+                   for classObj in mm.document_classes())
+    assert {'File', 'RoleAssignment', 'User'} <= set(classes)
+    assert mm.get_model('File') is classes['File']
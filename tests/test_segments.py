@@ -0,0 +1,130 @@
+import os, time
+import pytest
+
+import database as db
+import mongomanager.segments as segments
+
+def put(store, tmp_path, hashstring, data):
+    filename = str(tmp_path / 'source')
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return store.put(hashstring, filename, len(data))
+
+def age(store, hashstring, seconds):
+    with store._writing() as index:
+        index.execute('UPDATE objects SET added = added - ? WHERE hash = ?',
+                      (seconds, hashstring))
+
+def segment_numbers(tmp_path):
+    return set(int(name[:-4]) 
+               for name in os.listdir(str(tmp_path / '.segments'))
+               if name.endswith('.seg'))
+
+def test_put_and_open(tmp_path):
+    store = segments.SegmentStore(str(tmp_path))
+    assert put(store, tmp_path, 'aa', b'first') == (True, 5)
+    assert put(store, tmp_path, 'aa', b'other') == (False, 5)
+    with store.open('aa') as f:
+        assert f.read() == b'first'
+    with pytest.raises(KeyError):
+        store.view('bb')
+
+def test_compact(tmp_path):
+    store = segments.SegmentStore(str(tmp_path), segmentsize=10)
+    for hashstring in ('aa', 'bb', 'cc'):
+        put(store, tmp_path, hashstring, hashstring.encode()*4)
+        age(store, hashstring, 3600)
+    put(store, tmp_path, 'dd', b'young')
+    reclaimed = store.compact(lambda hashstring: hashstring == 'aa',
+                              time.time() - 60)
+    assert reclaimed > 0
+    assert store.lookup('bb') is None and store.lookup('cc') is None
+    with store.open('aa') as f:
+        assert f.read() == b'aaaaaaaa'
+    with store.open('dd') as f:
+        assert f.read() == b'young'
+
+# A new reference to an old unreferenced object, made while compaction
+# is working out what's live, is covered by the grace period
+def test_duplicate_put_refreshes_added(tmp_path):
+    store = segments.SegmentStore(str(tmp_path))
+    put(store, tmp_path, 'aa', b'data')
+    age(store, 'aa', 3600)
+    assert put(store, tmp_path, 'aa', b'data') == (False, 4)
+    store.compact(lambda hashstring: False, time.time() - 60)
+    assert store.lookup('aa') is not None
+
+# Compacting everything away mustn't hand out a removed segment's number
+# again: another process may still have it mapped
+def test_segment_numbers_are_not_reused(tmp_path):
+    store = segments.SegmentStore(str(tmp_path), segmentsize=10)
+    reader = segments.SegmentStore(str(tmp_path), segmentsize=10)
+    put(store, tmp_path, 'aa', b'A'*12)
+    put(store, tmp_path, 'bb', b'B'*12)
+    with reader.open('aa') as f:
+        assert f.read() == b'A'*12
+    used = segment_numbers(tmp_path)
+    store.compact(lambda hashstring: True, time.time() + 1, threshold=1)
+    used.update(segment_numbers(tmp_path))
+    assert reader.open('aa').read() == b'A'*12
+    store.compact(lambda hashstring: False, time.time() + 1)
+    # Dead compaction targets are reclaimed too
+    assert len(segment_numbers(tmp_path)) <= 1
+    put(store, tmp_path, 'dd', b'D'*12)
+    assert store.lookup('dd')[0] not in used
+    with reader.open('dd') as f:
+        assert f.read() == b'D'*12
+
+def test_stale_maps_are_replaced(tmp_path):
+    store = segments.SegmentStore(str(tmp_path))
+    put(store, tmp_path, 'aa', b'old')
+    segment = store.lookup('aa')[0]
+    with store.open('aa') as f:
+        assert f.read() == b'old'
+    replacement = str(tmp_path / 'replacement')
+    with open(replacement, 'wb') as f:
+        f.write(b'new')
+    os.replace(replacement, store.segmentname(segment))
+    with store.open('aa') as f:
+        assert f.read() == b'new'
+    os.remove(store.segmentname(segment))
+    with pytest.raises(KeyError):
+        store.view('aa')
+    assert segment not in store._maps
+
+@pytest.fixture
+def app(connection):
+    flask = pytest.importorskip('flask')
+    from mongomanager import mongomanager as mm
+    app = flask.Flask(__name__)
+    app.register_blueprint(mm.mongomanager)
+    return app
+
+@pytest.mark.parametrize('stored', ['slash', 'relative'])
+def test_compact_command_keeps_referenced_objects(app, user, tmp_path, 
+                                                  monkeypatch, stored):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(db.File, 'segmentthreshold', 1024)
+    basepath = str(tmp_path / 'store')
+    storedpath = basepath + '/' if stored == 'slash' else 'store'
+    files = []
+    for i in range(3):
+        fileObj = db.File(addedby=user, basepath=storedpath, filetype='bin')
+        assert fileObj.write(b'file %d' % i)
+        assert fileObj.storage == 'segment'
+        files.append(fileObj)
+    files[0].update(iscurrent=False)
+    result = app.test_cli_runner().invoke(
+            args=['mongomanager', 'compact', basepath, '--grace', '0',
+                  '--threshold', '1'])
+    assert result.exit_code == 0, result.output
+    for fileObj in files:
+        assert fileObj.read() is not None
+
+def test_compact_command_needs_documents(app, user, tmp_path):
+    store = segments.get_store(str(tmp_path))
+    put(store, tmp_path, 'aa', b'data')
+    result = app.test_cli_runner().invoke(
+            args=['mongomanager', 'compact', str(tmp_path), '--grace', '0'])
+    assert result.exit_code != 0
+    assert store.lookup('aa') is not None
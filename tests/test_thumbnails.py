@@ -0,0 +1,38 @@
+import io, os
+import pytest
+
+import mongomanager.thumbnails as thumbnails
+
+@pytest.fixture
+def Image():
+    return pytest.importorskip('PIL.Image')
+
+def image_file(user, tmp_path, data):
+    import database as db
+    fileObj = db.File(addedby=user, basepath=str(tmp_path), filetype='png')
+    assert fileObj.write(data)
+    return fileObj
+
+def test_thumbnail(Image, user, tmp_path):
+    buffer = io.BytesIO()
+    Image.new('RGB', (300, 200)).save(buffer, 'PNG')
+    fileObj = image_file(user, tmp_path, buffer.getvalue())
+    filename = thumbnails.thumbnail(fileObj, 30)
+    assert filename == thumbnails.derivative_name(fileObj, 30)
+    with Image.open(filename) as image:
+        assert image.size == (30, 20)
+
+# Unreadable images give None, in the pool too, and are not retried
+@pytest.mark.parametrize('data', [b'not an image', 
+                                  b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR'])
+def test_unreadable_images(Image, user, tmp_path, data, monkeypatch):
+    fileObj = image_file(user, tmp_path, data)
+    assert thumbnails.thumbnail(fileObj, 30) is None
+    future = thumbnails.schedule(fileObj, 40, 1)
+    assert future.result() is None
+    assert not os.path.exists(thumbnails.derivative_name(fileObj, 40))
+    def generate(*args):
+        raise AssertionError('retried')
+    monkeypatch.setattr(thumbnails, 'generate', generate)
+    assert thumbnails.schedule(fileObj, 40, 1) is None
+    assert thumbnails.thumbnail(fileObj, 30, 1) is None
@@ -0,0 +1,153 @@
+import os, json, time, hashlib
+import pytest
+
+import database as db
+import mongomanager.verify as verify
+
+def add_file(user, basepath, data):
+    fileObj = db.File(addedby=user, basepath=basepath, filetype='bin')
+    assert fileObj.write(data)
+    return fileObj
+
+def run(basepaths, **kwargs):
+    problems = []
+    verifier = verify.Verifier(basepaths, problems.append, processes=1,
+                               grace=0, **kwargs)
+    assert verifier.run()
+    return sorted(problems, key=lambda problem: problem['problem'])
+
+# A blob no document references, old enough to be reported
+def add_orphan(basepath, data):
+    hashstring = hashlib.sha256(data).hexdigest()
+    directory = os.path.join(basepath, hashstring[0:2], hashstring[2:4],
+                             hashstring[4:6])
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, hashstring[6:])
+    with open(filename, 'wb') as f:
+        f.write(data)
+    os.utime(filename, (time.time() - 3600,)*2)
+    return filename
+
+def test_blob_hashstring():
+    assert verify.blob_hashstring(os.path.join('ab', 'cd', 'ef', '01')) == \
+            'abcdef01'
+    assert verify.blob_hashstring(os.path.join('ab', 'cd', 'ef', '01.gz')) \
+            == 'abcdef01'
+    assert verify.blob_hashstring(os.path.join('.tmp', 'x')) is None
+
+# Thumbnails and previews stored next to a blob aren't blobs themselves
+def test_derivatives_are_not_blobs():
+    pytest.importorskip('flask')
+    from mongomanager import mongomanager as mm
+    import mongomanager.thumbnails as thumbnails
+    basepath = os.path.abspath('store')
+    fileObj = db.File(basepath=basepath, hashstring='abcdef0123')
+    assert verify.blob_hashstring(os.path.relpath(
+            os.path.join(fileObj.getpath(), fileObj.getfilename()),
+            basepath)) == 'abcdef0123'
+    for derivative in (thumbnails.derivative_name(fileObj, 128),
+                       mm.preview_name(fileObj, mm.PREVIEW_SIZE, 
+                                       mm.PREVIEW_DEPTH)):
+        assert verify.blob_hashstring(os.path.relpath(derivative, 
+                                                      basepath)) is None
+
+def test_digest_matches_collision_successor():
+    dataHash = hashlib.sha256(b'data')
+    successor = dataHash.copy()
+    successor.update(b'1')
+    assert verify.digest_matches(hashlib.sha256(b'data'), 
+                                 successor.hexdigest())
+    assert not verify.digest_matches(hashlib.sha256(b'other'),
+                                     successor.hexdigest())
+
+def test_healthy_store(user, tmp_path):
+    basepath = str(tmp_path)
+    for i in range(3):
+        add_file(user, basepath, b'file %d' % i)
+    assert run([basepath], repair=True) == []
+
+@pytest.mark.parametrize('stored', ['slash', 'relative'])
+def test_basepaths_compared_as_absolute_paths(user, tmp_path, monkeypatch,
+                                              stored):
+    basepath = str(tmp_path / 'store')
+    monkeypatch.chdir(tmp_path)
+    storedpath = basepath + '/' if stored == 'slash' else 'store'
+    files = [add_file(user, storedpath, b'file %d' % i) for i in range(3)]
+    for requested in (basepath, basepath + '/', 'store'):
+        assert run([requested], repair=True) == []
+    for fileObj in files:
+        fileObj.reload()
+        assert fileObj.iscurrent
+        assert fileObj.read() is not None
+
+def test_repair(user, tmp_path):
+    basepath = str(tmp_path)
+    good = add_file(user, basepath, b'good')
+    corrupt = add_file(user, basepath, b'corrupt')
+    dangling = add_file(user, basepath, b'dangling')
+    with open(corrupt.getstoredname(), 'wb') as f:
+        f.write(b'c0rrupt')
+    os.remove(dangling.getstoredname())
+    orphan = add_orphan(basepath, b'orphan')
+    problems = run([basepath], repair=True)
+    assert [problem['problem'] for problem in problems] == \
+            ['corrupt', 'dangling', 'orphan']
+    quarantine = os.path.join(basepath, verify.QUARANTINE)
+    for filename in (corrupt.getstoredname(), orphan):
+        assert not os.path.exists(filename)
+        assert os.path.exists(os.path.join(
+                quarantine, os.path.relpath(filename, basepath)))
+    for fileObj, iscurrent in ((good, True), (corrupt, False), 
+                               (dangling, False)):
+        fileObj.reload()
+        assert fileObj.iscurrent == iscurrent
+    assert good.read() == b'good'
+
+# ingest --link hard links files into the store before their documents
+# are inserted, so a fresh blob may have an old mtime
+def test_grace_period_covers_linked_blobs(user, tmp_path):
+    basepath = str(tmp_path / 'store')
+    add_file(user, basepath, b'referenced')
+    source = str(tmp_path / 'source')
+    with open(source, 'wb') as f:
+        f.write(b'linked')
+    os.utime(source, (time.time() - 86400,)*2)
+    hashstring = hashlib.sha256(b'linked').hexdigest()
+    directory = os.path.join(basepath, hashstring[0:2], hashstring[2:4],
+                             hashstring[4:6])
+    os.makedirs(directory, exist_ok=True)
+    linked = os.path.join(directory, hashstring[6:])
+    os.link(source, linked)
+    problems = []
+    verifier = verify.Verifier([basepath], problems.append, processes=1,
+                               repair=True, grace=3600)
+    assert verifier.run()
+    assert problems == []
+    assert os.path.exists(linked)
+
+def test_no_repair_without_documents(user, tmp_path):
+    basepath = str(tmp_path)
+    orphan = add_orphan(basepath, b'orphan')
+    problems = run([basepath], repair=True)
+    assert [problem['problem'] for problem in problems] == ['orphan']
+    assert os.path.exists(orphan)
+    assert not os.path.exists(os.path.join(basepath, verify.QUARANTINE))
+
+def test_carries_on_from_checkpoint(user, tmp_path, monkeypatch):
+    basepath = str(tmp_path / 'store')
+    for i in range(5):
+        add_file(user, basepath, b'file %d' % i)
+    statefile = str(tmp_path / 'state.json')
+    monkeypatch.setattr(verify, 'BATCH', 2)
+    problems = []
+    verifier = verify.Verifier([basepath], problems.append, processes=1,
+                               statefile=statefile, deadline=0)
+    assert not verifier.run()
+    with open(statefile) as f:
+        assert json.load(f)['counts']['checked'] == 2
+    verifier = verify.Verifier([basepath], problems.append, processes=1,
+                               statefile=statefile)
+    assert verifier.run()
+    assert verifier.state['counts']['checked'] == 5
+    assert problems == []
+    assert not os.path.exists(statefile)
@@ -0,0 +1,108 @@
+# thumbnails.py
+#
+# Downscaled PNG derivatives of image files, generated on first request
+# and stored content-addressed next to the original, under
+# File.getpath(), as <getfilename()>.<size>.png. Generation can run in a
+# background pool of worker threads so pages can schedule the sizes they
+# will ask for before the browser requests them. Images Pillow can't
+# read (corrupt, truncated, mislabelled or too large) are logged and
+# remembered for FAILURE_TTL seconds, and thumbnail() returns None for
+# them so callers can fall back to the original. Requires Pillow.
+#
+import os, io, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import database as db
+from mongomanager.cache import TTLCache
+
+try:
+    from PIL import Image
+    ERRORS = (OSError, Image.DecompressionBombError)
+except ImportError:
+    Image = None
+    ERRORS = (OSError,)
+
+FAILURE_TTL = 3600
+
+_executor = None
+_pending = dict()
+_failed = TTLCache(maxsize=4096, ttl=FAILURE_TTL)
+_lock = threading.Lock()
+
+def available():
+    return Image is not None
+
+def derivative_name(fileObj, size):
+    return os.path.join(fileObj.getpath(),
+                        '%s.%d.png' % (fileObj.getfilename(), size))
+
+# source is a filename or a binary file object
+def generate(source, target, size):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if not isinstance(source, str) and not source.seekable():
+        # Pillow needs to seek, which decompressing readers can't
+        source = io.BytesIO(source.read())
+    with Image.open(source) as image:
+        image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            image = image.convert('RGBA')
+        fd, tempname = tempfile.mkstemp(dir=os.path.dirname(target))
+        os.fchmod(fd, db.FILEMODE)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, 'PNG')
+            os.replace(tempname, target)
+        finally:
+            if os.path.exists(tempname):
+                os.remove(tempname)
+    return target
+
+# Like generate, but logs and remembers images Pillow can't read and
+# returns None for them
+def _generate(source, target, size):
+    try:
+        return generate(source, target, size)
+    except ERRORS as e:
+        db.logger.warning('Unable to generate thumbnail ' + target + 
+                          ': ' + repr(e))
+        _failed.set(target, True)
+        return None
+
+def _run(source, target, size):
+    try:
+        return _generate(source, target, size)
+    finally:
+        source.close()
+        with _lock:
+            _pending.pop(target, None)
+
+# Schedule a derivative on the worker pool (started with `workers`
+# threads on first use), returning a future, or None if it already
+# exists, has failed recently or there is no pool.
+def schedule(fileObj, size, workers):
+    global _executor
+    target = derivative_name(fileObj, size)
+    if workers <= 0 or os.path.exists(target) or _failed.get(target):
+        return None
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers)
+        future = _pending.get(target)
+        if future is None:
+            future = _executor.submit(_run, fileObj.open(), target, size)
+            _pending[target] = future
+    return future
+
+# Returns the derivative's filename, generating it if need be, or None
+# if the image can't be read.
+def thumbnail(fileObj, size, workers=0):
+    target = derivative_name(fileObj, size)
+    if os.path.exists(target):
+        return target
+    if _failed.get(target):
+        return None
+    future = schedule(fileObj, size, workers)
+    if future is not None:
+        return future.result()
+    with fileObj.open() as source:
+        return _generate(source, target, size)
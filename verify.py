@@ -0,0 +1,366 @@
+# verify.py
+#
+# Integrity check of the File store. Two passes per run:
+#
+#   blobs      re-hash every file in each basepath's hashstring fan-out
+#              directories and every object in its segments (corrupt),
+#              and look for ones no File document references (orphan)
+#   documents  stream the current File documents by _id and check that
+#              their contents exist (dangling)
+#
+# Hashing runs on a process pool, each worker limited to its share of a
+# byte rate. Progress is checkpointed to a state file after every batch,
+# so a run stopped by its time limit carries on from there next time; a
+# finished run removes the state file. With repair, corrupt and orphaned
+# files are moved to basepath/.quarantine and the File documents of
+# corrupt or missing contents are retired (iscurrent=False). Basepaths
+# are compared as absolute paths, and a basepath no File document uses
+# is never repaired.
+#
+import os, json, time, shutil, hashlib, traceback
+import multiprocessing
+from datetime import datetime
+import bson
+
+import database as db
+import mongomanager.segments as segments
+import mongomanager.archive as archive
+import mongomanager.compression as compression
+
+CHUNKSIZE = 1024*1024
+# Tasks per pool batch, and documents per checkpoint
+BATCH = 1000
+# A hash collision on write appends b'1' to the hash until the name is
+# free (see File.placefile), so a name may be that many updates away
+# from the content's own digest.
+MAX_COLLISIONS = 16
+QUARANTINE = '.quarantine'
+# Key of the raw File queries by basepath and hashstring, declared on File
+# without a _cls prefix and created on its history collection by run()
+REFERENCE_KEYS = [('basepath', 1), ('hashstring', 1)]
+
+# Whether the digest, or a collision successor of it, is the hashstring
+def digest_matches(dataHash, hashstring):
+    for i in range(MAX_COLLISIONS + 1):
+        if dataHash.hexdigest() == hashstring:
+            return True
+        dataHash.update('1'.encode('utf-8'))
+    return False
+
+# The encoding of a fan-out blob from its name's suffix
+def blob_encoding(relpath):
+    for encoding, suffix in compression.SUFFIXES.items():
+        if relpath.endswith(suffix):
+            return encoding
+    return ''
+
+# The hashstring of a fan-out blob from its path relative to basepath,
+# or None for anything else (derivatives have a '.' in their name, 
+# other than a compressed blob's suffix)
+def blob_hashstring(relpath):
+    encoding = blob_encoding(relpath)
+    if encoding:
+        relpath = relpath[:-len(compression.SUFFIXES[encoding])]
+    parts = relpath.split(os.sep)
+    if (len(parts) != 4 or any(len(part) != 2 for part in parts[:3]) or
+            '.' in parts[3]):
+        return None
+    return ''.join(parts)
+
+# The fan-out blobs under basepath in path order, after the given
+# relative path, skipping the store's dot directories
+def walk_blobs(basepath, after=''):
+    for dirpath, dirnames, filenames in os.walk(basepath):
+        reldir = os.path.relpath(dirpath, basepath)
+        reldir = '' if reldir == '.' else reldir + os.sep
+        dirnames[:] = sorted(name for name in dirnames
+                             if not name.startswith('.') and
+                             reldir + name >= after[:len(reldir + name)])
+        for filename in sorted(filenames):
+            relpath = reldir + filename
+            if relpath > after and blob_hashstring(relpath) is not None:
+                yield relpath
+
+# Hash a binary file object, reading at most rate bytes per second
+def hash_stream(f, rate):
+    dataHash = hashlib.sha256()
+    start = time.monotonic()
+    size = 0
+    for chunk in iter(lambda: f.read(CHUNKSIZE), b''):
+        dataHash.update(chunk)
+        size += len(chunk)
+        if rate:
+            delay = size/float(rate) - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+    return dataHash, size
+
+# Worker: verify one blob or segment object, given (basepath, kind, name,
+# rate) where name is a relative path or a hashstring. Contents that
+# can't be decompressed count as corrupt.
+def _check(args):
+    basepath, kind, name, rate = args
+    try:
+        if kind == 'segment':
+            hashstring = name
+            f = segments.get_store(basepath).open(hashstring)
+            mtime = None # Filled in from the segment index
+        else:
+            hashstring = blob_hashstring(name)
+            filename = os.path.join(basepath, name)
+            # A file hard linked into the store (ingest --link) keeps its
+            # old mtime, but linking updates its ctime
+            stat = os.stat(filename)
+            mtime = max(stat.st_mtime, stat.st_ctime)
+            f = compression.open_decompressed(filename, blob_encoding(name))
+    except (FileNotFoundError, KeyError):
+        # Removed since it was listed
+        return dict(kind=kind, name=name, missing=True)
+    except Exception:
+        return dict(kind=kind, name=name, error=traceback.format_exc())
+    try:
+        with f:
+            dataHash, size = hash_stream(f, rate)
+        ok = digest_matches(dataHash, hashstring)
+    except FileNotFoundError:
+        return dict(kind=kind, name=name, missing=True)
+    except Exception:
+        size = 0
+        ok = False
+    return dict(kind=kind, name=name, hashstring=hashstring, size=size,
+                mtime=mtime, ok=ok)
+
+def file_collections():
+    return (db.File._get_collection(), archive.history_collection(db.File))
+
+# The basepath values stored on live or archived File documents for each
+# of basepaths, by absolute path. Documents may hold a basepath with a
+# trailing slash, or relative to the working directory.
+def basepath_aliases(basepaths):
+    aliases = dict((os.path.abspath(basepath), []) 
+                   for basepath in basepaths)
+    stored = set()
+    for collection in file_collections():
+        stored.update(collection.distinct('basepath'))
+    for value in sorted(stored):
+        if value and os.path.abspath(value) in aliases:
+            aliases[os.path.abspath(value)].append(value)
+    return aliases
+
+# The hashstrings among hashes referenced by a live or archived File 
+# stored under one of the basepath aliases
+def referenced(aliases, hashes):
+    found = set()
+    for collection in file_collections():
+        found.update(collection.distinct('hashstring',
+                                         {'basepath': {'$in': aliases},
+                                          'hashstring': {'$in': hashes}}))
+    return found
+
+class Verifier(object):
+    # report(entry) is called with a dict for every problem found
+    def __init__(self, basepaths, report, processes=None, rate=None,
+                 statefile=None, repair=False, grace=3600,
+                 deadline=None):
+        self.basepaths = [os.path.abspath(basepath) 
+                          for basepath in basepaths]
+        self.aliases = None # Filled in by run()
+        self.report = report
+        self.processes = processes
+        self.workers = processes or multiprocessing.cpu_count()
+        self.rate = rate
+        self.statefile = statefile
+        self.repair = repair
+        self.grace = grace
+        self.deadline = deadline
+        self.state = dict(blobs=dict(), segments=dict(), documents=None,
+                          counts=dict(checked=0, bytes=0, corrupt=0,
+                                      orphan=0, dangling=0, errors=0))
+        if statefile is not None and os.path.exists(statefile):
+            with open(statefile, 'r') as f:
+                self.state = json.load(f)
+
+    def checkpoint(self):
+        if self.statefile is None:
+            return
+        tempname = self.statefile + '.tmp'
+        with open(tempname, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tempname, self.statefile)
+
+    def expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def problem(self, kind, basepath, **fields):
+        self.state['counts'][kind] += 1
+        self.report(dict(problem=kind, basepath=basepath, **fields))
+
+    # Move a blob out of the store, keeping its relative path
+    def quarantine(self, basepath, relpath):
+        target = os.path.join(basepath, QUARANTINE, relpath)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(os.path.join(basepath, relpath), target)
+        return target
+
+    # Whether files under basepath may be repaired. Without any File 
+    # documents using the basepath every file there looks orphaned.
+    def repairable(self, basepath):
+        return self.repair and len(self.aliases[basepath]) > 0
+
+    def retire(self, query):
+        now = datetime.utcnow()
+        db.File._get_collection().update_many(
+                dict(query, iscurrent=True),
+                {'$set': {'iscurrent': False, 'removeddate': now,
+                          'modifieddate': now}})
+
+    def handle(self, basepath, results):
+        hashes = [result['hashstring'] for result in results
+                  if 'hashstring' in result]
+        aliases = self.aliases[basepath]
+        found = referenced(aliases, hashes)
+        repair = self.repairable(basepath)
+        counts = self.state['counts']
+        for result in results:
+            if 'error' in result:
+                counts['errors'] += 1
+                db.logger.error('Unable to verify ' + result['name'] +
+                                '\n' + result['error'])
+                continue
+            if result.get('missing'):
+                continue
+            counts['checked'] += 1
+            counts['bytes'] += result['size']
+            hashstring = result['hashstring']
+            where = dict(hashstring=hashstring, storage=result['kind'])
+            if result['kind'] == 'blob':
+                where['path'] = result['name']
+            if not result['ok']:
+                self.problem('corrupt', basepath, **where)
+                if repair:
+                    self.retire({'basepath': {'$in': aliases},
+                                 'hashstring': hashstring})
+                    if result['kind'] == 'blob':
+                        self.quarantine(basepath, result['name'])
+                    else:
+                        segments.get_store(basepath).remove(hashstring)
+            elif hashstring not in found:
+                # Files are placed before their documents are saved
+                if (result['mtime'] is not None and
+                        result['mtime'] > time.time() - self.grace):
+                    continue
+                self.problem('orphan', basepath, **where)
+                # Orphaned segment objects are left to compaction
+                if repair and result['kind'] == 'blob':
+                    self.quarantine(basepath, result['name'])
+
+    # Check names on the pool. mtimes gives the modification times of
+    # segment objects, by hashstring.
+    def run_tasks(self, pool, basepath, kind, names, mtimes=None):
+        rate = self.rate/float(self.workers) if self.rate else None
+        results = pool.map(_check, [(basepath, kind, name, rate)
+                                    for name in names])
+        if mtimes is not None:
+            for result in results:
+                result['mtime'] = mtimes.get(result['name'])
+        self.handle(basepath, results)
+
+    def verify_blobs(self, pool, basepath):
+        after = self.state['blobs'].get(basepath, '')
+        if after is None:
+            return True
+        batch = []
+        for relpath in walk_blobs(basepath, after):
+            batch.append(relpath)
+            if len(batch) >= BATCH:
+                self.run_tasks(pool, basepath, 'blob', batch)
+                self.state['blobs'][basepath] = batch[-1]
+                self.checkpoint()
+                batch = []
+                if self.expired():
+                    return False
+        self.run_tasks(pool, basepath, 'blob', batch)
+        self.state['blobs'][basepath] = None
+        self.checkpoint()
+        return True
+
+    def verify_segments(self, pool, basepath):
+        after = self.state['segments'].get(basepath, '')
+        if after is None:
+            return True
+        if os.path.isdir(os.path.join(basepath, '.segments')):
+            store = segments.get_store(basepath)
+            while True:
+                rows = store.hashes(after, BATCH)
+                if len(rows) == 0:
+                    break
+                self.run_tasks(pool, basepath, 'segment',
+                               [hashstring for hashstring, added in rows],
+                               dict(rows))
+                after = rows[-1][0]
+                self.state['segments'][basepath] = after
+                self.checkpoint()
+                if self.expired():
+                    return False
+        self.state['segments'][basepath] = None
+        self.checkpoint()
+        return True
+
+    # Check that every current File document's contents exist
+    def verify_documents(self):
+        query = {'basepath': {'$in': [alias for basepath in self.basepaths
+                                      for alias in self.aliases[basepath]]},
+                 'iscurrent': True}
+        if self.state['documents'] is not None:
+            query['_id'] = {'$gt': bson.ObjectId(self.state['documents'])}
+        cursor = (db.File._get_collection()
+                  .find(query, {'basepath': 1, 'hashstring': 1,
+                                'storage': 1, 'encoding': 1})
+                  .sort('_id', 1).batch_size(BATCH))
+        count = 0
+        for doc in cursor:
+            basepath = os.path.abspath(doc['basepath'])
+            fileObj = db.File(basepath=basepath,
+                              hashstring=doc['hashstring'],
+                              encoding=doc.get('encoding', ''))
+            if doc.get('storage') == 'segment':
+                exists = (segments.get_store(basepath)
+                          .lookup(doc['hashstring']) is not None)
+            else:
+                exists = os.path.exists(fileObj.getstoredname())
+            if not exists:
+                self.problem('dangling', basepath, id=str(doc['_id']),
+                             hashstring=doc['hashstring'])
+                if self.repair:
+                    self.retire({'_id': doc['_id']})
+            count += 1
+            if count % BATCH == 0:
+                self.state['documents'] = str(doc['_id'])
+                self.checkpoint()
+                if self.expired():
+                    return False
+        return True
+
+    # Returns True if the run finished, False if it stopped at the
+    # deadline (the state file then holds where to carry on).
+    def run(self):
+        archive.history_collection(db.File).create_index(REFERENCE_KEYS)
+        self.aliases = basepath_aliases(self.basepaths)
+        for basepath in self.basepaths:
+            if self.repair and not self.repairable(basepath):
+                db.logger.warning('No File documents use ' + basepath + 
+                                  ', not repairing it')
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for basepath in self.basepaths:
+                if not (self.verify_blobs(pool, basepath) and
+                        self.verify_segments(pool, basepath)):
+                    return False
+        finally:
+            pool.close()
+            pool.join()
+        if not self.verify_documents():
+            return False
+        if self.statefile is not None and os.path.exists(self.statefile):
+            os.remove(self.statefile)
+        return True